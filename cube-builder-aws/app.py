@@ -125,6 +125,7 @@ def list_cubes(cube_id):
 def continue_process(event, context):
     with app.app_context():
         params_list = []
+        message_ids = []
         if 'Records' in event:
             for record in event['Records']:
                 if 'kinesis' in record:
@@ -134,9 +135,24 @@ def continue_process(event, context):
                 else:
                     params = json.loads(record['body'])
                     params_list.append(params)
+                    message_ids.append(record['messageId'])
         else:
             params = event
             params_list.append(params)
 
-        message = business.continue_process_stream(params_list)
-        return message
\ No newline at end of file
+        message = business.continue_process_stream(params_list, message_ids or None)
+        return message
+
+
+#########################################
+# REQUEST -> from the refresh schedule
+#########################################
+def refresh_assets(event, context):
+    with app.app_context():
+        refreshed = business.refresh_assets()
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "refreshed": refreshed
+            }),
+        }
@@ -0,0 +1,79 @@
+"""
+Range requests and wall time of the blend window loop reading block by block against
+coalesced reads (see `plan_reads`), by read budget.
+
+Scenes are read through /vsicurl/ from a local HTTP server with Range requests, like the
+public S3 urls blend reads; GDAL block cache is kept small so blocks are not reused between
+windows. Outputs are checked to be equal to the per-block loop.
+
+Usage:
+    python benchmarks/blend_coalesce.py [size] [scenes]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+
+from synthetic import RangeServer, ard_period
+from cube_builder_aws.utils.blend import blend_windows, plan_reads, window_itemsize
+
+NODATA = -9999
+BANDS = ['red', 'nir']
+# Read budgets in MB, None reads block by block
+BUDGETS = [None, 16, 64, 256]
+
+
+def run(urls, budget):
+    # Query of the budget, so the vsicurl cache of a previous run is not reused
+    urls = [dict((key, '{}?budget={}'.format(url, budget)) for key, url in scene.items()) for scene in urls]
+    # vsicurl region cache above the largest read, GDAL 3.10 stalls when large reads fill it
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', GDAL_CACHEMAX=16,
+                      CPL_VSIL_CURL_CACHE_SIZE=512 * 1024 * 1024):
+        scenes = [(dict((band, rasterio.open(scene[band])) for band in BANDS), rasterio.open(scene['quality']))
+                  for scene in urls]
+        try:
+            src = scenes[0][1]
+            windows = [window for _, window in src.block_windows()]
+            coalesce = budget * 1024 * 1024 if budget else None
+            reads = len(plan_reads(windows, coalesce, window_itemsize(scenes, BANDS))) if coalesce else len(windows)
+            outputs = numpy.zeros((len(BANDS) + 1, src.height, src.width), dtype=numpy.int16)
+            for window, (results, count_raster, _) in blend_windows(scenes, BANDS, windows, NODATA, 'int16',
+                                                                    coalesce_bytes=coalesce):
+                for index, band in enumerate(BANDS):
+                    outputs[index][window.toslices()] = results[band]['MED']
+                outputs[-1][window.toslices()] = count_raster
+        finally:
+            for ssrcs, msrc in scenes:
+                for ssrc in ssrcs.values():
+                    ssrc.close()
+                msrc.close()
+    return outputs, reads
+
+
+def main(size, count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = ard_period(tmpdir, size, count, bands=BANDS)
+        with RangeServer(tmpdir) as server:
+            urls = [dict((key, server.url(path)) for key, path in scene.items()) for scene in paths]
+
+            print('{} scenes of {}x{}, bands {}'.format(count, size, size, ','.join(BANDS)))
+            print('{:>10} {:>7} {:>9} {:>9} {:>9} {:>6}'.format(
+                'budget MB', 'reads', 'requests', 'MB sent', 'time (s)', 'equal'))
+            reference = None
+            for budget in BUDGETS:
+                server.reset()
+                start = time.time()
+                outputs, reads = run(urls, budget)
+                elapsed = time.time() - start
+                if reference is None:
+                    reference = outputs
+                print('{:>10} {:>7} {:>9} {:>9.1f} {:>9.2f} {:>6}'.format(
+                    budget or 'block', reads, server.requests, server.bytes / 2. ** 20, elapsed,
+                    str(numpy.array_equal(reference, outputs))))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 4096, args[1] if len(args) > 1 else 8)
@@ -0,0 +1,61 @@
+"""
+Wall time of the blend window loop by number of workers.
+
+Every worker opens its own handles of the scenes; outputs are checked to be equal
+to the sequential loop.
+
+Usage:
+    python benchmarks/blend_parallel.py [size] [scenes] [workers ...]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+
+from synthetic import ard_period
+from cube_builder_aws.utils.blend import blend_windows
+
+NODATA = -9999
+
+
+def run(paths, workers):
+    scenes = [({'red': rasterio.open(scene['red'])}, rasterio.open(scene['quality'])) for scene in paths]
+    try:
+        src = scenes[0][1]
+        outputs = [numpy.zeros((src.height, src.width), dtype=numpy.int16) for _ in range(3)]
+        windows = [window for _, window in src.block_windows()]
+        for window, (results, count_raster, _) in blend_windows(scenes, ['red'], windows, NODATA, 'int16',
+                                                                workers=workers):
+            for output, result in zip(outputs, (results['red']['MED'], results['red']['STK'], count_raster)):
+                output[window.toslices()] = result
+        return outputs
+    finally:
+        for ssrcs, msrc in scenes:
+            ssrcs['red'].close()
+            msrc.close()
+
+
+def main(size, count, workers_list):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = ard_period(tmpdir, size, count)
+
+        print('{} scenes of {}x{}'.format(count, size, size))
+        print('{:>8} {:>10} {:>8} {:>6}'.format('workers', 'time (s)', 'speedup', 'equal'))
+        reference = None
+        for workers in workers_list:
+            start = time.time()
+            outputs = run(paths, workers)
+            elapsed = time.time() - start
+            if reference is None:
+                reference = (outputs, elapsed)
+            equal = all(numpy.array_equal(a, b) for a, b in zip(reference[0], outputs))
+            print('{:>8} {:>10.2f} {:>8.2f} {:>6}'.format(workers, elapsed, reference[1] / elapsed, str(equal)))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    size = args[0] if len(args) > 0 else 4096
+    count = args[1] if len(args) > 1 else 12
+    main(size, count, args[2:] or [1, 2, 4])
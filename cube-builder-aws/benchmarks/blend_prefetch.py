@@ -0,0 +1,70 @@
+"""
+Pipeline timing of the blend window loop with and without prefetching reads.
+
+Scenes are read through /vsicurl/ from a local HTTP server with Range requests, like the
+public S3 urls blend reads. Each row prints the PipelineTiming report; outputs are checked
+to be equal to the loop without prefetch.
+
+Usage:
+    python benchmarks/blend_prefetch.py [size] [scenes]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+
+from synthetic import RangeServer, ard_period
+from cube_builder_aws.utils.blend import PipelineTiming, blend_windows
+
+NODATA = -9999
+BANDS = ['red', 'nir']
+# (prefetch, readers, workers)
+CONFIGS = [(0, 1, 1), (2, 1, 1), (4, 2, 1), (4, 2, 2)]
+
+
+def run(urls, prefetch, readers, workers):
+    timing = PipelineTiming()
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', GDAL_CACHEMAX=16):
+        scenes = [(dict((band, rasterio.open(scene[band])) for band in BANDS), rasterio.open(scene['quality']))
+                  for scene in urls]
+        try:
+            src = scenes[0][1]
+            windows = [window for _, window in src.block_windows()]
+            medians = numpy.zeros((len(BANDS), src.height, src.width), dtype=numpy.int16)
+            for window, (results, _, _) in blend_windows(scenes, BANDS, windows, NODATA, 'int16',
+                    workers=workers, prefetch=prefetch, prefetch_bytes=256 * 1024 * 1024,
+                    readers=readers, timing=timing):
+                for index, band in enumerate(BANDS):
+                    medians[index][window.toslices()] = results[band]['MED']
+        finally:
+            for ssrcs, msrc in scenes:
+                for ssrc in ssrcs.values():
+                    ssrc.close()
+                msrc.close()
+    return medians, timing
+
+
+def main(size, count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = ard_period(tmpdir, size, count, bands=BANDS)
+        with RangeServer(tmpdir) as server:
+            urls = [dict((key, server.url(path)) for key, path in scene.items()) for scene in paths]
+
+            print('{} scenes of {}x{}, bands {}'.format(count, size, size, ','.join(BANDS)))
+            reference = None
+            for prefetch, readers, workers in CONFIGS:
+                start = time.time()
+                medians, timing = run(urls, prefetch, readers, workers)
+                elapsed = time.time() - start
+                if reference is None:
+                    reference = medians
+                print('prefetch {} readers {} workers {} - {:.2f}s equal {}\n    {}'.format(
+                    prefetch, readers, workers, elapsed, numpy.array_equal(reference, medians),
+                    timing.report()))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 2048, args[1] if len(args) > 1 else 8)
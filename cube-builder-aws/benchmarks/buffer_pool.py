@@ -0,0 +1,99 @@
+"""
+Array allocations and wall time of the merge and blend loops with and without reusing
+the work arrays (BufferPool).
+
+Without reuse every scene, window and work array is a new allocation, as before the
+pool. Outputs must be equal.
+
+Usage:
+    python benchmarks/buffer_pool.py [size] [scenes]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+from rasterio.warp import Resampling
+
+from synthetic import CRS, ard_period, scenes_over_tile, tile_grid
+from cube_builder_aws.utils.blend import blend_windows
+from cube_builder_aws.utils.builder import BufferPool
+from cube_builder_aws.utils.warp import merge_full, merge_windowed
+
+NODATA = -9999
+BANDS = ['red', 'nir']
+
+
+def merge(links, band, size, windowed, pool):
+    transform, numcol, numlin = tile_grid(size)
+    nodata = 0 if band == 'quality' else NODATA
+    resampling = Resampling.nearest if band == 'quality' else Resampling.bilinear
+    if not windowed:
+        return merge_full(links, 'LC8SR', band, CRS, transform, numcol, numlin, nodata, resampling,
+                          pool=pool)[0]
+
+    output = numpy.zeros((numlin, numcol), dtype=numpy.uint16 if band == 'quality' else numpy.int16)
+
+    def write(window, data):
+        output[window.toslices()] = data
+
+    merge_windowed(links, 'LC8SR', band, CRS, transform, numcol, numlin, nodata, resampling, 512, write,
+                   pool=pool)
+    return output
+
+
+def blend(paths, pool):
+    scenes = [(dict((band, rasterio.open(scene[band])) for band in BANDS), rasterio.open(scene['quality']))
+              for scene in paths]
+    try:
+        src = scenes[0][1]
+        outputs = numpy.zeros((2 * len(BANDS) + 1, src.height, src.width), dtype=numpy.int16)
+        windows = [window for _, window in src.block_windows()]
+        for window, (results, count_raster, _) in blend_windows(scenes, BANDS, windows, NODATA, 'int16',
+                                                                functions=('MED', 'STK', 'AVG'), pool=pool):
+            for index, band in enumerate(BANDS):
+                outputs[2 * index][window.toslices()] = results[band]['MED']
+                outputs[2 * index + 1][window.toslices()] = results[band]['AVG']
+            outputs[-1][window.toslices()] = count_raster
+        return outputs
+    finally:
+        for ssrcs, msrc in scenes:
+            for ssrc in ssrcs.values():
+                ssrc.close()
+            msrc.close()
+
+
+def measure(name, run):
+    print(name)
+    reference = None
+    for reuse in (False, True):
+        pool = BufferPool(reuse=reuse)
+        start = time.time()
+        output = run(pool)
+        elapsed = time.time() - start
+        if reference is None:
+            reference = output
+        print('{:>10} {:>8} {:>12} {:>10.2f} {:>6}'.format(
+            'pool' if reuse else 'no pool', pool.takes, pool.allocations, elapsed,
+            str(numpy.array_equal(reference, output))))
+
+
+def main(size, count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print('{:>10} {:>8} {:>12} {:>10} {:>6}'.format('', 'arrays', 'allocations', 'time (s)', 'equal'))
+        for band in ('red', 'quality'):
+            links = scenes_over_tile(tmpdir, size, count=count, band=band)
+            measure('merge full {} - {} scenes of {}x{}'.format(band, count, size, size),
+                    lambda pool: merge(links, band, size, False, pool))
+            measure('merge windowed {} - {} scenes of {}x{}'.format(band, count, size, size),
+                    lambda pool: merge(links, band, size, True, pool))
+
+        paths = ard_period(tmpdir, size, 3 * count, bands=BANDS)
+        measure('blend {} - {} dates of {}x{}'.format(','.join(BANDS), 3 * count, size, size),
+                lambda pool: blend(paths, pool))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 4096, args[1] if len(args) > 1 else 4)
@@ -0,0 +1,109 @@
+"""
+Time of the Landsat-8 SR cloud mask of a merged pixel_qa tile: getMask before the
+lookup table kernel against lc8sr_mask and getMaskStats, by tile size.
+
+The pixel_qa tiles have cloud and shadow blobs with clear holes, scattered cloudy
+pixels, snow, saturated pixels and fill areas (0 warped and 1 pixel_qa fill). The
+masks must be equal and the efficacy and cloud ratio the same.
+
+Usage:
+    python benchmarks/mask_kernel.py [size ...]
+"""
+import os
+import sys
+import time
+
+import numpy
+from scipy import ndimage as ndi
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cube_builder_aws.utils.builder import getMaskStats, lc8sr_mask, remove_small_holes
+
+# pixel_qa codes: clear land, clear water, cloud shadow, snow, high cloud, cirrus, saturated
+CLEAR = [322, 324]
+NOTCLEAR = [328, 336, 480, 834, 898, 1346, 322 + 8]
+
+
+def reference_mask(raster):
+    # Implementation of getMask for LC8SR before the lookup table kernel
+    fill = 1
+    radsat = 4 + 8
+    cloud = 16 + 32 + 64
+    shadow = 128 + 256
+    snowice = 512 + 1024
+    cirrus = 2048 + 4096
+
+    imagearea = numpy.zeros(raster.shape, dtype=numpy.bool_)
+    imagearea = imagearea + raster > fill
+    notcleararea = (raster & radsat > 4) + \
+        (raster & cloud > 64) + \
+        (raster & shadow > 256) + \
+        (raster & snowice > 512) + \
+        (raster & cirrus > 4096)
+
+    strel = numpy.ones((6, 6), dtype=numpy.uint16)
+    out = numpy.empty(notcleararea.shape, dtype=numpy.bool_)
+    ndi.binary_dilation(notcleararea, structure=strel, output=out)
+    notcleararea = out
+
+    remove_small_holes(notcleararea, area_threshold=80, connectivity=1, in_place=True)
+
+    cleararea = imagearea * numpy.invert(notcleararea)
+    rastercm = (2 * notcleararea + cleararea).astype(numpy.uint16)
+
+    totpix = rastercm.size
+    clearpix = numpy.count_nonzero(rastercm == 1)
+    cloudpix = numpy.count_nonzero(rastercm == 2)
+    imagearea = clearpix + cloudpix
+    cloudratio = 100
+    if imagearea != 0:
+        cloudratio = round(100. * cloudpix / imagearea, 1)
+    efficacy = round(100. * clearpix / totpix, 2)
+    return rastercm, efficacy, cloudratio
+
+
+def kernel_mask(raster):
+    rastercm = lc8sr_mask(raster)
+    cloudratio, efficacy = getMaskStats(rastercm)
+    return rastercm, efficacy, cloudratio
+
+
+def synthetic_qa(size, seed=0):
+    rng = numpy.random.RandomState(seed)
+    rows = numpy.arange(size, dtype=numpy.float32)[:, None]
+    cols = numpy.arange(size, dtype=numpy.float32)[None, :]
+    raster = numpy.array(CLEAR, dtype=numpy.uint16)[rng.randint(0, len(CLEAR), size=(size, size))]
+
+    blobs = numpy.sin(cols / 80.) * numpy.sin(rows / 55.) > 0.6
+    codes = numpy.array(NOTCLEAR, dtype=numpy.uint16)[rng.randint(0, len(NOTCLEAR), size=(size, size))]
+    # clear holes of a few pixels inside the blobs and scattered not clear pixels
+    notclear = (blobs & (rng.random_sample((size, size)) > 0.02)) | (rng.random_sample((size, size)) < 0.002)
+    raster[notclear] = codes[notclear]
+
+    raster[:, :size // 10] = 0
+    raster[:size // 20, :] = 1
+    return raster
+
+
+def main(sizes):
+    print('{:>7} {:>12} {:>12} {:>8} {:>6}'.format('size', 'getMask (s)', 'kernel (s)', 'speedup', 'equal'))
+    for size in sizes:
+        raster = synthetic_qa(size)
+
+        start = time.time()
+        expected = reference_mask(raster)
+        reference_time = time.time() - start
+
+        start = time.time()
+        result = kernel_mask(raster)
+        kernel_time = time.time() - start
+
+        equal = numpy.array_equal(expected[0], result[0]) and expected[1:] == result[1:]
+        print('{:>7} {:>12.3f} {:>12.3f} {:>8.1f} {:>6}'.format(
+            size, reference_time, kernel_time, reference_time / kernel_time, str(equal)))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1024, 2048, 4096, 6000])
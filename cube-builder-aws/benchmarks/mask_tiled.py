@@ -0,0 +1,43 @@
+"""
+Wall time of the Landsat-8 SR cloud mask by number of workers, the image processed by
+chunks of rows (lc8sr_mask with halo dilation and holes joined across chunks).
+
+Masks are checked to be equal to the whole image mask. The chunks run in a thread pool,
+the gain depends on the cores of the machine (Lambda gives more vCPUs with more memory).
+
+Usage:
+    python benchmarks/mask_tiled.py [size] [workers ...]
+"""
+import os
+import sys
+import time
+
+import numpy
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cube_builder_aws.utils.builder import lc8sr_mask
+from mask_kernel import synthetic_qa
+
+
+def main(size, workers_list):
+    raster = synthetic_qa(size)
+    print('pixel_qa of {}x{}, {} cores'.format(size, size, os.cpu_count()))
+    print('{:>8} {:>10} {:>10} {:>8} {:>6}'.format('workers', 'chunk', 'time (s)', 'speedup', 'equal'))
+    reference = None
+    for workers in workers_list:
+        for chunk_rows in (None, 256):
+            start = time.time()
+            mask = lc8sr_mask(raster, workers, chunk_rows)
+            elapsed = time.time() - start
+            if reference is None:
+                reference = (mask, elapsed)
+            print('{:>8} {:>10} {:>10.3f} {:>8.2f} {:>6}'.format(
+                workers, chunk_rows or -(-size // workers), elapsed, reference[1] / elapsed,
+                str(numpy.array_equal(reference[0], mask))))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 6000, args[1:] or [1, 2, 4])
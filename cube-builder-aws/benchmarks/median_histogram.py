@@ -0,0 +1,71 @@
+"""
+Peak memory and time of the blend median of a window: stacked (median_int16) against
+streamed (median_histogram), by number of scenes.
+
+Scenes are generated one at a time, as blend reads them, so the peak memory of the
+histogram median does not include a stack. Outputs must be equal.
+
+Usage:
+    python benchmarks/median_histogram.py [window]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cube_builder_aws.utils.composite import median_histogram, median_int16
+
+NODATA = -9999
+SCENES = [10, 50, 100, 200, 400]
+
+
+def read_scene(order, window):
+    rng = numpy.random.RandomState(order)
+    raster = rng.randint(0, 10001, size=(window, window)).astype(numpy.int16)
+    bmask = rng.random_sample((window, window)) < 0.4
+    return raster, bmask
+
+
+def stacked(scenes, window):
+    stack = numpy.empty((scenes, window, window), dtype=numpy.int16)
+    stack_bmask = numpy.empty((scenes, window, window), dtype=numpy.bool_)
+    for order in range(scenes):
+        stack[order], stack_bmask[order] = read_scene(order, window)
+    return median_int16(stack, stack_bmask, NODATA)
+
+
+def streamed(scenes, window):
+    def read_scenes():
+        for order in range(scenes):
+            yield read_scene(order, window)
+    return median_histogram(read_scenes, (window, window), NODATA)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 2. ** 20
+
+
+def main(window):
+    print('{:>7} {:>7} {:>10} {:>10} {:>10} {:>10} {:>6}'.format(
+        'window', 'scenes', 'sort MB', 'sort (s)', 'hist MB', 'hist (s)', 'equal'))
+    for scenes in SCENES:
+        expected, sort_time, sort_peak = measure(stacked, scenes, window)
+        result, hist_time, hist_peak = measure(streamed, scenes, window)
+        equal = all(numpy.array_equal(a, b) for a, b in zip(expected, result))
+        print('{:>7} {:>7} {:>10.1f} {:>10.2f} {:>10.1f} {:>10.2f} {:>6}'.format(
+            window, scenes, sort_peak, sort_time, hist_peak, hist_time, str(equal)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 512)
@@ -0,0 +1,66 @@
+"""
+Time of the blend median (MED) per window: numpy.ma.median against median_int16.
+
+The stacks are random int16 reflectances with about 40% of cloudy pixels and some
+pixels masked in every scene. The output of both must be bit-for-bit equal after the
+pixels without observations are set to nodata, as blend does.
+
+Usage:
+    python benchmarks/median_kernel.py [window ...]
+"""
+import os
+import sys
+import time
+
+import numpy
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cube_builder_aws.utils.composite import median_int16
+
+NODATA = -9999
+SCENES = [5, 10, 25, 50, 100, 200]
+
+
+def ma_median(stack, bmask, nodata):
+    # Implementation used by blend before median_int16
+    stackMA = numpy.ma.zeros(stack.shape, dtype=numpy.int16)
+    for order in range(stack.shape[0]):
+        stackMA[order] = numpy.ma.masked_where(bmask[order], stack[order])
+    median_raster = numpy.ma.median(stackMA, axis=0).data
+    median_raster[numpy.all(bmask, axis=0)] = nodata
+    return median_raster.astype(numpy.int16), numpy.ma.count(stackMA, axis=0)
+
+
+def synthetic_stack(scenes, window, seed=0):
+    rng = numpy.random.RandomState(seed)
+    stack = rng.randint(-200, 10001, size=(scenes, window, window)).astype(numpy.int16)
+    bmask = rng.random_sample(stack.shape) < 0.4
+    bmask[:, :window // 8, :] = True
+    stack[bmask & (rng.random_sample(stack.shape) < 0.5)] = NODATA
+    return stack, bmask
+
+
+def main(windows):
+    print('{:>7} {:>7} {:>12} {:>12} {:>8} {:>6}'.format(
+        'window', 'scenes', 'ma (s)', 'kernel (s)', 'speedup', 'equal'))
+    for window in windows:
+        for scenes in SCENES:
+            stack, bmask = synthetic_stack(scenes, window)
+
+            start = time.time()
+            expected, expected_count = ma_median(stack, bmask, NODATA)
+            ma_time = time.time() - start
+
+            start = time.time()
+            median, count = median_int16(stack, bmask, NODATA)
+            kernel_time = time.time() - start
+
+            equal = numpy.array_equal(expected, median) and numpy.array_equal(expected_count, count)
+            print('{:>7} {:>7} {:>12.3f} {:>12.3f} {:>8.1f} {:>6}'.format(
+                window, scenes, ma_time, kernel_time, ma_time / kernel_time, str(equal)))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [256, 512])
@@ -0,0 +1,65 @@
+"""
+Bytes and requests read by merge_warped when the scenes cover only a corner of the tile,
+with the GDAL warper reading the band ('band') and with footprint window reads ('footprint').
+
+The pixels of the footprint read must be the ones of the band read, with scenes over a corner
+of the tile or over the whole tile (scale 1).
+
+Usage:
+    python benchmarks/merge_footprint.py [size] [scale] [scenes]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+from rasterio.warp import Resampling
+
+from synthetic import CRS, RangeServer, scenes_over_tile, tile_grid
+from cube_builder_aws.utils.warp import merge_full
+
+# every read goes to the server, as in a fresh lambda container
+ENV = dict(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', VSI_CACHE=False, GDAL_CACHEMAX=64,
+           CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif')
+
+
+def compare(reference, raster):
+    # Pixels of raster different from reference, their fraction and the largest difference
+    diff = numpy.abs(reference.astype(numpy.int32) - raster)
+    different = numpy.count_nonzero(diff)
+    return different, different / float(diff.size), int(diff.max())
+
+
+def main(size, scale, count):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        transform, numcol, numlin = tile_grid(size)
+        files = scenes_over_tile(tmpdir, size, count=count, scale=scale)
+
+        with RangeServer(tmpdir) as server:
+            print('{0} scenes of {1}x{1} pixels over a {2}x{2} tile'.format(count, size * scale, size))
+            print('{:>10} {:>10} {:>12} {:>9} {:>10} {:>9} {:>8}'.format(
+                'read', 'requests', 'MB read', 'time (s)', 'different', 'fraction', 'max diff'))
+            reference = None
+            for read in ('band', 'footprint'):
+                # other urls for each read, so GDAL does not answer from the blocks cached by the last one
+                links = ['{}?{}'.format(server.url(path), read) for path in files]
+                with rasterio.Env(**ENV):
+                    server.reset()
+                    start = time.time()
+                    raster_merge, _ = merge_full(links, 'S2SR', 'red', CRS, transform, numcol, numlin,
+                        -9999, Resampling.bilinear, read=read)
+                    elapsed = time.time() - start
+                if reference is None:
+                    reference = raster_merge
+                print('{:>10} {:>10} {:>12.2f} {:>9.2f} {:>10} {:>9.2%} {:>8}'.format(
+                    read, server.requests, server.bytes / 1024. / 1024., elapsed,
+                    *compare(reference, raster_merge)))
+                assert numpy.array_equal(reference, raster_merge), \
+                    '{} read differs from the band read'.format(read)
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 2048, args[1] if len(args) > 1 else 3,
+         args[2] if len(args) > 2 else 2)
@@ -0,0 +1,100 @@
+"""
+Peak memory (RSS) of merge_warped full-array and window merge modes by tile size.
+The window merge must have the same pixels of the full-array merge.
+
+Usage:
+    python benchmarks/merge_memory.py [size ...]
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+import numpy
+import rasterio
+from rasterio.warp import Resampling
+
+from synthetic import CRS, scenes_over_tile, tile_grid
+from cube_builder_aws.utils.warp import get_merge_template_from_links, merge_full, merge_windowed
+
+BLOCK_SIZE = 512
+NODATA = -9999
+
+
+def run(mode, links, size, output, queue):
+    transform, numcol, numlin = tile_grid(size)
+    start = time.time()
+    if mode == 'full':
+        raster_merge, template = merge_full(links, 'S2SR', 'red', CRS, transform,
+            numcol, numlin, NODATA, Resampling.bilinear)
+        template.update(tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE, compress='LZW')
+        with rasterio.open(output, 'w', **template) as dst:
+            dst.write_band(1, raster_merge)
+    else:
+        template = get_merge_template_from_links(links, 'S2SR', 'red', CRS, transform,
+            numcol, numlin, NODATA)
+        template.update(tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE, compress='LZW')
+        with rasterio.open(output, 'w', **template) as dst:
+            merge_windowed(links, 'S2SR', 'red', CRS, transform, numcol, numlin, NODATA,
+                Resampling.bilinear, BLOCK_SIZE, lambda w, d: dst.write(d, window=w, indexes=1))
+    elapsed = time.time() - start
+    queue.put((peak_rss(), elapsed))
+
+
+def peak_rss():
+    # Peak RSS in MB. VmHWM is reset on exec, while ru_maxrss is inherited from the parent on Linux
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(mode, links, size, output):
+    # A fresh process for each run, so the peak is of that run only.
+    # GDAL block cache is limited, otherwise it hides the arrays used by the merge
+    os.environ.setdefault('GDAL_CACHEMAX', '64')
+    ctx = get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run, args=(mode, links, size, output, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def compare(full, window):
+    # Percentage of pixels that differ and the largest difference
+    with rasterio.open(full) as a, rasterio.open(window) as b:
+        diff = numpy.zeros(2, dtype=numpy.int64)
+        for _, w in a.block_windows():
+            x = a.read(1, window=w).astype(numpy.int32)
+            y = b.read(1, window=w).astype(numpy.int32)
+            diff[0] += numpy.count_nonzero(x != y)
+            diff[1] = max(diff[1], int(numpy.abs(x - y).max()))
+        return 100. * diff[0] / (a.width * a.height), diff[1]
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print('{:>8} {:>14} {:>15} {:>9} {:>10} {:>9} {:>9}'.format(
+            'size', 'full RSS (MB)', 'window RSS (MB)', 'full (s)', 'window (s)', 'diff (%)', 'max diff'))
+        for size in sizes:
+            links = scenes_over_tile(tmpdir, size, count=2)
+            full = os.path.join(tmpdir, 'full_{}.tif'.format(size))
+            window = os.path.join(tmpdir, 'window_{}.tif'.format(size))
+            full_rss, full_time = measure('full', links, size, full)
+            window_rss, window_time = measure('window', links, size, window)
+            diff, max_diff = compare(full, window)
+            print('{:>8} {:>14.1f} {:>15.1f} {:>9.2f} {:>10.2f} {:>9.3f} {:>9}'.format(
+                size, full_rss, window_rss, full_time, window_time, diff, max_diff))
+            assert max_diff == 0, 'window merge of {0}x{0} differs from the full merge'.format(size)
+
+
+if __name__ == '__main__':
+    main([int(s) for s in sys.argv[1:]] or [1024, 2048, 4096, 8192])
@@ -0,0 +1,46 @@
+"""
+Wall time of merge_warped scene reprojection by number of workers.
+
+Scenes are local files here; against S3 the sequential merge also waits on the
+network, so the gain of the thread pool is larger.
+
+Usage:
+    python benchmarks/merge_parallel.py [size] [scenes] [workers ...]
+"""
+import sys
+import tempfile
+import time
+
+import numpy
+from rasterio.warp import Resampling
+
+from synthetic import CRS, scenes_over_tile, tile_grid
+from cube_builder_aws.utils.warp import merge_full
+
+
+def main(size, scenes, workers_list):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        transform, numcol, numlin = tile_grid(size)
+        for band, resampling in (('red', Resampling.bilinear), ('quality', Resampling.nearest)):
+            links = scenes_over_tile(tmpdir, size, count=scenes, band=band)
+            nodata = 0 if band == 'quality' else -9999
+
+            print('{} band - {} scenes of {}x{}'.format(band, scenes, size, size))
+            print('{:>8} {:>10} {:>8} {:>6}'.format('workers', 'time (s)', 'speedup', 'equal'))
+            reference = None
+            for workers in workers_list:
+                start = time.time()
+                raster_merge, _ = merge_full(links, 'LC8SR', band, CRS, transform, numcol, numlin,
+                    nodata, resampling, workers=workers)
+                elapsed = time.time() - start
+                if reference is None:
+                    reference = (raster_merge, elapsed)
+                print('{:>8} {:>10.2f} {:>8.2f} {:>6}'.format(
+                    workers, elapsed, reference[1] / elapsed, str(numpy.array_equal(reference[0], raster_merge))))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    size = args[0] if len(args) > 0 else 4096
+    scenes = args[1] if len(args) > 1 else 4
+    main(size, scenes, args[2:] or [1, 2, 4])
@@ -0,0 +1,120 @@
+"""
+Time of the publish quicklooks of a period: the serial generateQLook before the overview
+reads and the lookup table, writing PNGs to /tmp, against generateQLook in a thread pool,
+from the images and from their quicklook sidecars (the time to write them, as merge and
+blend do, is also shown).
+
+Scenes have 3 bands with overviews, as merge and blend write them, in local files (GDAL
+of the RangeServer of the other benchmarks stalls on the overview reads of vsicurl here).
+The PNGs must have the same chunks, but the creation time text.
+
+Usage:
+    python benchmarks/quicklook.py [size] [scenes] [workers]
+"""
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy
+import rasterio
+from numpngw import write_png
+from rasterio.enums import Resampling
+
+from synthetic import ard_period
+from cube_builder_aws.utils.builder import QLOOK_LINES, generateQLook, ordered_map, quicklook_path, \
+    quicklook_sidecar
+
+BANDS = ['red', 'green', 'blue']
+
+
+def reference_quicklook(generalSceneId, qlfiles, directory):
+    # Implementation of generateQLook before the overview reads and the lookup table
+    profile = None
+    with rasterio.open(qlfiles[0]) as src:
+        profile = src.profile
+
+    numlin = QLOOK_LINES
+    numcol = int(float(profile['width'])/float(profile['height'])*numlin)
+    image = numpy.ones((numlin,numcol,len(qlfiles),), dtype=numpy.uint8)
+    pngname = os.path.join(directory, '{}.png'.format(generalSceneId))
+
+    nb = 0
+    for file in qlfiles:
+        with rasterio.open(file) as src:
+            raster = src.read(1, out_shape=(numlin, numcol))
+            # Rescale to 0-255 values
+            nodata = raster <= 0
+            if raster.min() != 0 or raster.max() != 0:
+                raster = raster.astype(numpy.float32)/10000.*255.
+                raster[raster>255] = 255
+            image[:,:,nb] = raster.astype(numpy.uint8) * numpy.invert(nodata)
+            nb += 1
+
+    write_png(pngname, image, transparent=(0, 0, 0))
+    return pngname
+
+
+def png_chunks(data):
+    # Chunks of a PNG file but its text (numpngw writes the creation time)
+    chunks, offset = [], 8
+    while offset < len(data):
+        length, kind = struct.unpack('>I4s', data[offset:offset + 8])
+        if kind != b'tEXt':
+            chunks.append(data[offset:offset + 12 + length])
+        offset += 12 + length
+    return chunks
+
+
+def add_overviews(scenes):
+    for scene in scenes:
+        for path in scene.values():
+            with rasterio.open(path, 'r+') as dataset:
+                dataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
+                dataset.update_tags(ns='rio_overview', resampling='nearest')
+
+
+def main(size, count, workers):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = ard_period(tmpdir, size, count, bands=BANDS)
+        add_overviews(paths)
+        pngdir = os.path.join(tmpdir, 'png')
+        os.mkdir(pngdir)
+
+        print('{} scenes of {}x{}, bands {}'.format(count, size, size, ','.join(BANDS)))
+        qlfiles = [[scene[band] for band in BANDS] for scene in paths]
+
+        start = time.time()
+        reference = []
+        for i, files in enumerate(qlfiles):
+            pngname = reference_quicklook('scene_{}'.format(i), files, pngdir)
+            with open(pngname, 'rb') as f:
+                reference.append(png_chunks(f.read()))
+            os.remove(pngname)
+        print('reference serial - {:.2f}s'.format(time.time() - start))
+
+        for run_workers in sorted(set([1, workers])):
+            start = time.time()
+            pngs = [png_chunks(png.getvalue()) for png in ordered_map(generateQLook, qlfiles, run_workers)]
+            print('overviews workers {} - {:.2f}s, equal {}'.format(
+                run_workers, time.time() - start, pngs == reference))
+
+        start = time.time()
+        for files in qlfiles:
+            for file in files:
+                with quicklook_sidecar(file) as memfile, open(quicklook_path(file), 'wb') as f:
+                    f.write(memfile.read())
+        print('sidecars written - {:.2f}s'.format(time.time() - start))
+
+        for run_workers in sorted(set([1, workers])):
+            start = time.time()
+            pngs = [png_chunks(png.getvalue()) for png in ordered_map(
+                lambda files: generateQLook(files, sidecars=True), qlfiles, run_workers)]
+            print('sidecars workers {} - {:.2f}s, equal {}'.format(
+                run_workers, time.time() - start, pngs == reference))
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if len(args) > 0 else 4096, args[1] if len(args) > 1 else 8,
+         args[2] if len(args) > 2 else 8)
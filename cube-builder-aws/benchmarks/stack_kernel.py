@@ -0,0 +1,76 @@
+"""
+Time of the blend best pixel (STK) per window: loop over the scenes against the
+first clear selection of stack_composite.
+
+The stacks are random int16 reflectances with about 40% of cloudy pixels, some pixels
+masked in every scene and some nodata values in clear pixels (STK gives 0 for them).
+The output of both must be bit-for-bit equal, the scene index of the selection is
+checked against the scene chosen by the loop.
+
+Usage:
+    python benchmarks/stack_kernel.py [window ...]
+"""
+import os
+import sys
+import time
+
+import numpy
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cube_builder_aws.utils.composite import first_clear, stack_composite
+
+NODATA = -9999
+SCENES = [5, 10, 25, 50, 100, 200]
+
+
+def loop_stack(stack, bmask, nodata, dtype):
+    # Implementation used by blend before first_clear, with the scene of each pixel
+    stack_raster = numpy.zeros(stack.shape[1:], dtype=dtype)
+    index = numpy.full(stack.shape[1:], nodata, dtype=numpy.int16)
+    notdonemask = numpy.ones(stack.shape[1:], dtype=numpy.bool_)
+    for order in range(stack.shape[0]):
+        raster = stack[order].copy()
+        raster[raster == nodata] = 0
+        todomask = notdonemask * numpy.invert(bmask[order])
+        notdonemask = notdonemask * bmask[order]
+        stack_raster += (todomask * raster.astype(dtype))
+        index[todomask] = order
+    stack_raster[notdonemask] = nodata
+    return stack_raster, index
+
+
+def synthetic_stack(scenes, window, seed=0):
+    rng = numpy.random.RandomState(seed)
+    stack = rng.randint(-200, 10001, size=(scenes, window, window)).astype(numpy.int16)
+    bmask = rng.random_sample(stack.shape) < 0.4
+    bmask[:, :window // 8, :] = True
+    stack[rng.random_sample(stack.shape) < 0.05] = NODATA
+    return stack, bmask
+
+
+def main(windows):
+    print('{:>7} {:>7} {:>12} {:>12} {:>8} {:>6}'.format(
+        'window', 'scenes', 'loop (s)', 'select (s)', 'speedup', 'equal'))
+    for window in windows:
+        for scenes in SCENES:
+            stack, bmask = synthetic_stack(scenes, window)
+
+            start = time.time()
+            expected, expected_index = loop_stack(stack, bmask, NODATA, 'int16')
+            loop_time = time.time() - start
+
+            start = time.time()
+            stack_raster = stack_composite(stack, bmask, NODATA, 'int16')
+            kernel_time = time.time() - start
+
+            index, found = first_clear(bmask)
+            equal = numpy.array_equal(expected, stack_raster) and \
+                numpy.array_equal(expected_index, numpy.where(found, index, NODATA))
+            print('{:>7} {:>7} {:>12.3f} {:>12.3f} {:>8.1f} {:>6}'.format(
+                window, scenes, loop_time, kernel_time, loop_time / kernel_time, str(equal)))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [256, 512])
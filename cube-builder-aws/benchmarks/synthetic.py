@@ -0,0 +1,179 @@
+"""
+Synthetic ARD scenes used by the benchmarks.
+
+The scenes are written as local GeoTIFF files, so the benchmarks do not need
+AWS credentials or access to the archive bucket.
+"""
+import os
+import re
+import sys
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import numpy
+import rasterio
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+
+# allow `python benchmarks/<script>.py` from the cube-builder-aws directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# BDC albers equal area projection
+CRS = '+proj=aea +lat_1=10 +lat_2=-40 +lat_0=0 +lon_0=-54 +x_0=0 +y_0=0 +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+SCENE_CRS = 'EPSG:32722'
+
+
+def tile_grid(size, res=10):
+    """Return (transform, numcol, numlin) of a `size` x `size` tile."""
+    xmin, ymax = 400000., -1000000.
+    return Affine(res, 0, xmin, 0, -res, ymax), size, size
+
+
+def write_scene(path, transform, crs, width, height, band='red', seed=0, block_size=512):
+    """Write a tiled scene with random reflectance (or pixel_qa codes for quality)."""
+    rng = numpy.random.RandomState(seed)
+    if band == 'quality':
+        codes = numpy.array([1, 322, 322, 322, 324, 328, 352, 386, 480, 834, 898, 1346], dtype=numpy.uint16)
+        data = codes[rng.randint(0, len(codes), size=(height, width))]
+        dtype, nodata = 'uint16', 1
+    else:
+        # smooth surface, like reflectance
+        rows = numpy.arange(height, dtype=numpy.float32)[:, None]
+        cols = numpy.arange(width, dtype=numpy.float32)[None, :]
+        data = 5000. + 3000. * numpy.sin(cols / 50. + seed) * numpy.cos(rows / 70.)
+        data = data.astype(numpy.int16)
+        data[:, :width // 10] = -9999
+        dtype, nodata = 'int16', -9999
+
+    profile = dict(driver='GTiff', width=width, height=height, count=1, dtype=dtype,
+                   crs=crs, transform=transform, nodata=nodata, tiled=True,
+                   blockxsize=block_size, blockysize=block_size, compress='LZW')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def scenes_over_tile(directory, size, count=2, band='red', res=10, scale=1):
+    """
+    Write `count` scenes in UTM shifted over the tile of `tile_grid(size, res)`.
+    With `scale` > 1 the scenes are `scale` times the tile and only their corner covers it.
+    """
+    transform, numcol, numlin = tile_grid(size, res)
+    bounds = (transform.c, transform.f - numlin * res, transform.c + numcol * res, transform.f)
+    west, south, east, north = transform_bounds(CRS, SCENE_CRS, *bounds)
+
+    links = []
+    width = int((east - west) / res)
+    height = int((north - south) / res)
+    for i in range(count):
+        shift = (i - count / 2.) * width / (2. * count) * res
+        if scale > 1:
+            # lower right corner of the scene in the middle of the tile
+            scene_transform = Affine(res, 0, (west + east) / 2. - width * scale * res + shift, 0, -res,
+                                     (north + south) / 2. + height * scale * res - shift / 2.)
+        else:
+            scene_transform = Affine(res, 0, west + shift, 0, -res, north - shift / 2.)
+        path = os.path.join(directory, 'scene_{}_{}_{}.tif'.format(band, size, i))
+        links.append(write_scene(path, scene_transform, SCENE_CRS, width * scale, height * scale,
+                                 band=band, seed=i))
+    return links
+
+
+def ard_period(directory, size, count, bands=('red',), res=10, block_size=512):
+    """
+    Write `count` merged ARD dates of the tile of `tile_grid(size, res)`, as blend reads them.
+    Quality is the merge mask (0 fill, 1 clear, 2 cloud).
+    Returns a list of {band: path} per date, including 'quality'.
+    """
+    transform, numcol, numlin = tile_grid(size, res)
+    profile = dict(driver='GTiff', width=numcol, height=numlin, count=1, crs=CRS, transform=transform,
+                   tiled=True, blockxsize=block_size, blockysize=block_size, compress='LZW')
+    rows = numpy.arange(numlin, dtype=numpy.float32)[:, None]
+    cols = numpy.arange(numcol, dtype=numpy.float32)[None, :]
+
+    scenes = []
+    for i in range(count):
+        rng = numpy.random.RandomState(i)
+        # cloudy blobs over a sparse clear/cloud noise
+        clouds = numpy.sin(cols / 90. + i) * numpy.sin(rows / 60. - i) > 0.3
+        mask = numpy.where(clouds | (rng.random_sample((numlin, numcol)) < 0.1), 2, 1).astype(numpy.uint16)
+        mask[:, :(i * numcol) // (4 * count)] = 0
+
+        scene = {}
+        path = os.path.join(directory, 'ard_{}_{}_quality.tif'.format(size, i))
+        with rasterio.open(path, 'w', dtype='uint16', nodata=0, **profile) as dst:
+            dst.write(mask, 1)
+        scene['quality'] = path
+
+        for b, band in enumerate(bands):
+            data = 3000. + 2000. * numpy.sin(cols / 50. + b) * numpy.cos(rows / 70. + i / 10.)
+            data = (data + rng.normal(0, 300, size=data.shape)).astype(numpy.int16)
+            data[mask == 0] = -9999
+            path = os.path.join(directory, 'ard_{}_{}_{}.tif'.format(size, i, band))
+            with rasterio.open(path, 'w', dtype='int16', nodata=-9999, **profile) as dst:
+                dst.write(data, 1)
+            scene[band] = path
+        scenes.append(scene)
+    return scenes
+
+
+class RangeServer(object):
+    """
+    HTTP server of a local directory with Range requests, like the public S3 urls.
+    Counts the requests and bytes sent, so GDAL reads through /vsicurl/ can be measured.
+    """
+
+    def __init__(self, directory):
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                SimpleHTTPRequestHandler.__init__(self, *args, directory=directory, **kwargs)
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.translate_path(self.path)
+                if not os.path.isfile(path):
+                    return self.send_error(404)
+                size = os.path.getsize(path)
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                start, end = 0, size - 1
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    body = f.read(end - start + 1)
+                self.send_response(206 if match else 200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Accept-Ranges', 'bytes')
+                if match:
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.requests += 1
+                    server.bytes += len(body)
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return '/vsicurl/http://127.0.0.1:{}/{}'.format(self.httpd.server_port, os.path.basename(path))
+
+    def reset(self):
+        with self.lock:
+            self.requests, self.bytes = 0, 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
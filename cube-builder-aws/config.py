@@ -9,13 +9,58 @@ USER = os.environ.get('RDS_USER', '')
 PASSWORD = os.environ.get('RDS_PASSWORD', '')
 
 URL_STAC = os.environ.get('URL_STAC', '')
+# minimum fraction (0-1) of the tile polygon a STAC scene must cover to be merged
+STAC_MIN_OVERLAP = float(os.environ.get('STAC_MIN_OVERLAP', 0))
 
 BUCKET_NAME = os.environ.get('BUCKET_NAME', '')
 LAMBDA_FUNCTION_NAME = os.environ.get('LAMBDA_FUNCTION_NAME', '')
 QUEUE_NAME = os.environ.get('QUEUE_NAME', '')
+# queue of blends, publishes and large merges, consumed one message per invocation (empty: use QUEUE_NAME)
+HEAVY_QUEUE_NAME = os.environ.get('HEAVY_QUEUE_NAME', '')
 KINESIS_NAME = os.environ.get('KINESIS_NAME', '')
 DYNAMO_TB_ACTIVITY = os.environ.get('DYNAMO_TB_ACTIVITY', '')
 DBNAME_TB_CONTROL = os.environ.get('DBNAME_TB_CONTROL', '')
+# merge/blend/publish activities of a SQS batch processed concurrently (only light merges)
+STREAM_WORKERS = int(os.environ.get('STREAM_WORKERS', 1))
+# messages of the SQS event source mapping batch of the stream lambda
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1))
+# largest merge (numcol * numlin) sharing a batch with other activities, heavier ones go to HEAVY_QUEUE_NAME
+STREAM_LIGHT_PIXELS = int(os.environ.get('STREAM_LIGHT_PIXELS', 25000000))
+# concurrent batch requests when dispatching buffered SQS messages and Kinesis records
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+
+# merge_warped mode: 'full' (whole tile in memory) or 'window' (block streaming)
+MERGE_MODE = os.environ.get('MERGE_MODE', 'full')
+# number of scenes of a date fetched and warped concurrently by merge_warped
+MERGE_WORKERS = int(os.environ.get('MERGE_WORKERS', 1))
+# how merge_warped reads the scenes: 'band' (GDAL warper) or 'footprint' (only the window over the tile)
+MERGE_READ = os.environ.get('MERGE_READ', 'band')
+# threads of the cloud mask of the merged quality band, each one with a chunk of rows
+MASK_WORKERS = int(os.environ.get('MASK_WORKERS', 1))
+# rows of the chunks of the cloud mask (0 is one chunk per thread)
+MASK_CHUNK_ROWS = int(os.environ.get('MASK_CHUNK_ROWS', 0))
+# blend activities: 'band' (one per band) or 'multiband' (all bands of a tile/period, quality read once)
+BLEND_MODE = os.environ.get('BLEND_MODE', 'band')
+# number of threads compositing blend windows
+BLEND_WORKERS = int(os.environ.get('BLEND_WORKERS', 1))
+# blend median: 'sort' (scenes stacked in memory) or 'histogram' (scenes streamed, from HISTOGRAM_MIN_SCENES scenes)
+BLEND_MEDIAN = os.environ.get('BLEND_MEDIAN', 'sort')
+# windows read ahead of the blend composite (0 reads each window when it is composited)
+BLEND_PREFETCH = int(os.environ.get('BLEND_PREFETCH', 0))
+# memory budget (MB) of the windows read ahead
+BLEND_PREFETCH_MB = int(os.environ.get('BLEND_PREFETCH_MB', 512))
+# threads reading the windows ahead, each one with its own handles of the scenes
+BLEND_READERS = int(os.environ.get('BLEND_READERS', 1))
+# memory budget (MB) of the coalesced blend reads of adjacent windows (0 reads window by window)
+BLEND_READ_MB = int(os.environ.get('BLEND_READ_MB', 0))
+# write the index of the source scene of each STACK pixel next to the STACK cube (0/1)
+BLEND_PROVENANCE = int(os.environ.get('BLEND_PROVENANCE', 0))
+# quicklooks of a publish activity rendered and uploaded concurrently
+QLOOK_WORKERS = int(os.environ.get('QLOOK_WORKERS', 1))
+# merge and blend store the quicklook bands next to their images, read by publish (0/1)
+QLOOK_SIDECARS = int(os.environ.get('QLOOK_SIDECARS', 0))
+# minimum seconds between asset materialized view refreshes by publish (the last publish of a cube and the scheduled app_refresh refresh it)
+MV_REFRESH_INTERVAL = int(os.environ.get('MV_REFRESH_INTERVAL', 0))
 
 ENABLE_OBT_OAUTH = os.environ.get('ENABLE_OBT_OAUTH', None)
 AUTH_CLIENT_SECRET_KEY = os.environ.get('AUTH_CLIENT_SECRET_KEY', '')
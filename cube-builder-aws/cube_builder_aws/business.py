@@ -1,17 +1,22 @@
 import json
 import rasterio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from flask import current_app
 from geoalchemy2 import func
 
 from bdc_db.models.base_sql import BaseModel, db
 from bdc_db.models import Collection, Band, CollectionTile, CollectionItem, Tile, \
-    GrsSchema, RasterSizeSchema
+    GrsSchema, RasterSizeSchema, CompositeFunctionSchema
 
 from .utils.serializer import Serializer
 from .utils.builder import get_date, get_cube_id
+from .utils.composite import COMPOSITES, DEFAULT_FUNCTIONS, DESCRIPTIONS, get_functions
 from .maestro import orchestrate, prepare_merge, \
-    merge_warped, solo, blend, publish
-from .services import CubeServices
+    merge_warped, solo, blend, publish, flush_asset_view
+from .services import CubeServices, is_light_activity
+from config import STREAM_WORKERS
+
 
 class CubeBusiness:
 
@@ -21,7 +26,12 @@ class CubeBusiness:
         self.services = CubeServices()
 
     def create_cube(self, params):
-        params['composite_function_list'] = ['IDENTITY', 'STK', 'MED']
+        functions = [function.upper() for function in params.get('composite_function_list') or DEFAULT_FUNCTIONS]
+        # the IDENTITY cube (warped scenes) is the input of all composites
+        if 'IDENTITY' not in functions:
+            functions.insert(0, 'IDENTITY')
+        params['composite_function_list'] = functions
+        self.create_composite_functions(functions)
 
         # generate cubes metadata
         cubes_db = Collection.query().filter().all()
@@ -156,18 +166,20 @@ class CubeBusiness:
         ), 200
 
     def start_process(self, params):
-        cube_id = get_cube_id(params['datacube'], 'MED')
         tiles = params['tiles'].split(',')
         start_date = datetime.strptime(params['start_date'], '%Y-%m-%d').strftime('%Y-%m-%d')
         end_date = datetime.strptime(params['end_date'], '%Y-%m-%d').strftime('%Y-%m-%d') \
             if params.get('end_date') else datetime.now().strftime('%Y-%m-%d')
 
-        # verify cube info
-        cube_infos = Collection.query().filter(
-            Collection.id == cube_id
-        ).first()
-        if not cube_infos:
+        # verify cube info, the composite cubes (registered in blend) give the functions to build
+        cubes = Collection.query().filter(
+            Collection.id.in_([get_cube_id(params['datacube'], function) for function in COMPOSITES])
+        ).all()
+        cubes = dict((cube.composite_function_schema_id, cube) for cube in cubes)
+        functions = get_functions(list(cubes.keys()))
+        if not functions:
             return 'Cube not found!', 404
+        cube_infos = cubes.get('MED', cubes[functions[0]])
 
         # get bands list
         bands = Band.query().filter(
@@ -177,23 +189,40 @@ class CubeBusiness:
 
         # items => old mosaic
         # orchestrate
-        self.score['items'] = orchestrate(params['datacube'], cube_infos, tiles, start_date, end_date)
+        self.score['items'] = orchestrate(params['datacube'], cube_infos, tiles, start_date, end_date, functions)
 
-        # prepare merge
-        prepare_merge(self, params['datacube'], params['collections'].split(','), bands_list,
-            cube_infos.bands_quicklook, bands[0].resolution_x, bands[0].resolution_y, bands[0].fill,
-            cube_infos.raster_size_schemas.raster_size_x, cube_infos.raster_size_schemas.raster_size_y,
-            cube_infos.raster_size_schemas.chunk_size_x, cube_infos.grs_schema.crs)
+        # prepare merge (messages are sent in batches when it finishes)
+        with self.services.dispatch():
+            prepare_merge(self, params['datacube'], params['collections'].split(','), bands_list,
+                cube_infos.bands_quicklook, bands[0].resolution_x, bands[0].resolution_y, bands[0].fill,
+                cube_infos.raster_size_schemas.raster_size_x, cube_infos.raster_size_schemas.raster_size_y,
+                cube_infos.raster_size_schemas.chunk_size_x, cube_infos.grs_schema.crs, functions)
 
         return 'Succesfully', 201
 
-    def continue_process_stream(self, params_list):
+    def continue_process_stream(self, params_list, message_ids=None):
         params = params_list[0]
-        if 'channel' in params and params['channel'] == 'kinesis':
-            solo(self, params_list)
+        failures = []
+        with self.services.dispatch():
+            if 'channel' in params and params['channel'] == 'kinesis':
+                solo(self, params_list)
+            else:
+                failures = self.process_batch(params_list, message_ids)
+
+        response = {
+            "statusCode": 200,
+            "body": json.dumps({
+                "message": 'Succesfully'
+            }),
+        }
+        # SQS partial batch response, only the failed messages return to the queue
+        if message_ids:
+            response['batchItemFailures'] = [{'itemIdentifier': message_id} for message_id in failures]
+        return response
 
+    def process_activity(self, params):
         # dispatch MERGE
-        elif params['action'] == 'merge':
+        if params['action'] == 'merge':
             merge_warped(self, params)
 
         # dispatch BLEND
@@ -204,12 +233,56 @@ class CubeBusiness:
         elif params['action'] == 'publish':
             publish(self, params)
 
-        return {
-            "statusCode": 200,
-            "body": json.dumps({
-                "message": 'Succesfully'
-            }),
-        }
+    def process_batch(self, params_list, message_ids=None):
+        """
+        Run the activities of a batch: the light merges in a bounded pool of workers and
+        the heavy ones one after the other. Heavy activities have their own queue with
+        batches of one message (HEAVY_QUEUE_NAME), so they only share a batch when it is
+        not configured. Returns the message ids of the activities that failed.
+        """
+        # a single activity keeps the lambda error, so the message is retried by the queue
+        if len(params_list) == 1:
+            self.process_activity(params_list[0])
+            return []
+
+        app = current_app._get_current_object()
+        message_ids = message_ids or [None] * len(params_list)
+
+        def run(item):
+            params, message_id = item
+            with app.app_context():
+                try:
+                    self.process_activity(params)
+                    return None
+                except Exception as e:
+                    params['mystatus'] = 'ERROR {}'.format(e)
+                    self.services.put_item_kinesis(params)
+                    return message_id
+
+        light, heavy = [], []
+        for item in zip(params_list, message_ids):
+            (light if is_light_activity(item[0]) else heavy).append(item)
+
+        failures = [run(item) for item in heavy]
+        with ThreadPoolExecutor(max_workers=STREAM_WORKERS) as executor:
+            failures.extend(executor.map(run, light))
+        return [message_id for message_id in failures if message_id is not None]
+
+    def refresh_assets(self):
+        # trailing refresh of the asset view, left dirty by the publishes within the interval
+        return flush_asset_view(self.services)
+
+    def create_composite_functions(self, functions):
+        # composite function schemas of the registry missing in the database (e.g. AVG, MIN, MAX)
+        functions = [function for function in functions if function in DESCRIPTIONS]
+        existing = set(schema.id for schema in CompositeFunctionSchema.query().filter(
+            CompositeFunctionSchema.id.in_(functions)).all())
+        for function in functions:
+            if function not in existing:
+                CompositeFunctionSchema(
+                    id=function,
+                    description=DESCRIPTIONS[function]
+                ).save()
 
     def create_grs(self, name, description, projection, meridian, degreesx, degreesy, bbox):
         bbox = bbox.split(',')
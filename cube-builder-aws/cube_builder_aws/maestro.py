@@ -1,53 +1,67 @@
 import json
 import os
+import time
 import numpy
 import rasterio
 
+from collections import OrderedDict
+from contextlib import ExitStack
 from datetime import datetime
 from geoalchemy2 import func
-from sqlalchemy import or_ 
+from sqlalchemy import or_, text
+from sqlalchemy.dialects.postgresql import insert
 from rasterio.transform import Affine 
-from rasterio.warp import reproject, Resampling, transform
+from rasterio.warp import Resampling, transform
 from rasterio.merge import merge 
 from rasterio.io import MemoryFile
 from sqlalchemy_utils import refresh_materialized_view
 
 from bdc_db.models.base_sql import BaseModel, db
 from bdc_db.models import CollectionTile, CollectionItem, Tile, \
-    Collection, Asset, Band
+    Collection, Asset, AssetMV, Band
 
 from .utils.builder import decode_periods, encode_key, \
-    getMaskStats, getMask, generateQLook, get_cube_id
-from config import BUCKET_NAME
-
-
-def orchestrate(datacube, cube_infos, tiles, start_date, end_date):
+    getMaskStats, getMask, generateQLook, get_cube_id, get_date_overlap, get_qa_decoder, \
+    ordered_map, quicklook_path, quicklook_sidecar
+from .utils.blend import HISTOGRAM_FUNCTIONS, HISTOGRAM_MIN_SCENES, PipelineTiming, blend_windows
+from .utils.composite import DEFAULT_FUNCTIONS, get_functions
+from .utils.warp import get_merge_template_from_links, merge_full, merge_windowed
+from config import BUCKET_NAME, MERGE_MODE, MERGE_WORKERS, MERGE_READ, MASK_WORKERS, MASK_CHUNK_ROWS, \
+    BLEND_MODE, BLEND_WORKERS, BLEND_MEDIAN, BLEND_PREFETCH, BLEND_PREFETCH_MB, BLEND_READERS, \
+    BLEND_READ_MB, BLEND_PROVENANCE, QLOOK_WORKERS, QLOOK_SIDECARS, \
+    MV_REFRESH_INTERVAL
+
+
+def orchestrate(datacube, cube_infos, tiles, start_date, end_date, functions):
     # create collection_tiles
+    tiles = list(set(tiles))
     tiles_by_grs = db.session() \
-        .query(Tile, func.ST_AsText(func.ST_BoundingDiagonal(Tile.geom_wgs84))) \
+        .query(Tile, func.ST_XMin(Tile.geom_wgs84), func.ST_YMin(Tile.geom_wgs84),
+            func.ST_XMax(Tile.geom_wgs84), func.ST_YMax(Tile.geom_wgs84),
+            func.ST_AsGeoJSON(Tile.geom_wgs84)) \
         .filter(
             Tile.grs_schema_id == cube_infos.grs_schema_id,
             Tile.id.in_(tiles)
         ).all()
+    tiles_infos = dict((tile_info[0].id, tile_info) for tile_info in tiles_by_grs)
+
+    cube_ids = [get_cube_id(datacube, function) for function in ['IDENTITY'] + functions]
+    existing_tiles = set(db.session() \
+        .query(CollectionTile.collection_id, CollectionTile.tile_id) \
+        .filter(
+            CollectionTile.collection_id.in_(cube_ids),
+            CollectionTile.grs_schema_id == cube_infos.grs_schema_id,
+            CollectionTile.tile_id.in_(tiles)
+        ).all())
 
     collection_tiles = []
-    tiles = list(set(tiles))
-    tiles_infos = {}
     for tile in tiles:
         # verify tile exists
-        tile_info = list(filter(lambda t: t[0].id == tile, tiles_by_grs))
-        if not tile_info:
+        if tile not in tiles_infos:
             return 'tile ({}) not found in GRS ({})'.format(tile, cube_infos.grs_schema_id), 404
 
-        tiles_infos[tile] = tile_info[0]
-        for function in ['IDENTITY', 'STK', 'MED']:
-            cube_id = get_cube_id(datacube, function)
-            collection_tile = CollectionTile.query().filter(
-                CollectionTile.collection_id == cube_id,
-                CollectionTile.grs_schema_id == cube_infos.grs_schema_id,
-                CollectionTile.tile_id == tile
-            ).first()
-            if not collection_tile:
+        for cube_id in cube_ids:
+            if (cube_id, tile) not in existing_tiles:
                 collection_tiles.append(CollectionTile(
                     collection_id=cube_id,
                     grs_schema_id=cube_infos.grs_schema_id,
@@ -55,22 +69,40 @@ def orchestrate(datacube, cube_infos, tiles, start_date, end_date):
                 ))
     BaseModel.save_all(collection_tiles)
 
-    # get cube start_date if exists
-    collections_items = CollectionItem.query().filter(
-        CollectionItem.collection_id == cube_infos.id,
-        CollectionItem.grs_schema_id == cube_infos.grs_schema_id
-    ).order_by(CollectionItem.composite_start).all()
+    # get cube start_date if exists, when the tiles already have items of the cube
+    items_id = set(item_id for item_id, in db.session() \
+        .query(CollectionItem.id) \
+        .filter(
+            CollectionItem.collection_id == cube_infos.id,
+            CollectionItem.grs_schema_id == cube_infos.grs_schema_id,
+            CollectionItem.tile_id.in_(tiles)
+        ).all())
     cube_start_date = start_date
-    if list(filter(lambda c_i: c_i.tile_id == tile, collections_items)):
-        cube_start_date = collections_items[0].composite_start 
+    if items_id:
+        cube_start_date = db.session() \
+            .query(func.min(CollectionItem.composite_start)) \
+            .filter(
+                CollectionItem.collection_id == cube_infos.id,
+                CollectionItem.grs_schema_id == cube_infos.grs_schema_id
+            ).scalar()
 
     # get/mount timeline
     temporal_schema = cube_infos.temporal_composition_schema.temporal_schema
     step = cube_infos.temporal_composition_schema.temporal_composite_t
     timeline = decode_periods(temporal_schema.upper(), cube_start_date, end_date, int(step))
 
+    # bounding box and geometry of each tile
+    tiles_items = {}
+    for tile in tiles:
+        tile_info = tiles_infos[tile]
+        tiles_items[tile] = {
+            'bbox': ','.join(str(coordinate) for coordinate in tile_info[1:5]),
+            'geom': json.loads(tile_info[5]),
+            'xmin': tile_info[0].min_x,
+            'ymax': tile_info[0].max_y
+        }
+
     # create collection items (old model => mosaic)
-    items_id = []
     items = {}
     for datekey in sorted(timeline):
         requestedperiod = timeline[datekey]
@@ -81,35 +113,23 @@ def orchestrate(datacube, cube_infos, tiles, start_date, end_date):
             if end_date is not None and p_enddate > end_date : continue
 
             for tile in tiles:
-                bbox = tiles_infos[tile][1].replace('LINESTRING(', '') \
-                    .replace('LINESTRING Z (', '') \
-                    .replace(')', '') \
-                    .replace(' ', ',') \
-                    .split(',')
-                if len(bbox) != 4:
-                    del bbox[2]
-                    del bbox[-1]
-
-                items[tile] = items.get(tile, {})
-                items[tile]['bbox'] = ','.join(bbox)
-                items[tile]['xmin'] = tiles_infos[tile][0].min_x
-                items[tile]['ymax'] = tiles_infos[tile][0].max_y
-                items[tile]['periods'] = items[tile].get('periods', {})
+                if tile not in items:
+                    items[tile] = dict(tiles_items[tile], periods={})
 
+                # periods without item of the cube, each item once
                 item_id = '{}_{}_{}'.format(cube_infos.id, tile, p_basedate)
                 if item_id not in items_id:
-                    items_id.append(item_id)
-                    if not list(filter(lambda c_i: c_i.id == item_id, collections_items)):
-                        items[tile]['periods'][periodkey] = {
-                            'collection': cube_infos.id,
-                            'grs_schema_id': cube_infos.grs_schema_id,
-                            'tile_id': tile,
-                            'item_date': p_basedate,
-                            'id': item_id,
-                            'composite_start': p_startdate,
-                            'composite_end': p_enddate,
-                            'dirname': '{}/{}/'.format(get_cube_id(datacube), tile)
-                        }
+                    items_id.add(item_id)
+                    items[tile]['periods'][periodkey] = {
+                        'collection': cube_infos.id,
+                        'grs_schema_id': cube_infos.grs_schema_id,
+                        'tile_id': tile,
+                        'item_date': p_basedate,
+                        'id': item_id,
+                        'composite_start': p_startdate,
+                        'composite_end': p_enddate,
+                        'dirname': '{}/{}/'.format(get_cube_id(datacube), tile)
+                    }
     return items
 
 
@@ -145,10 +165,34 @@ def next_step(services, activity):
                 next_publish(services, activity)
           
 
+def set_pending_publish(services, datacube, activity, pending):
+    """
+    Mark the publish of the tile/period of activity as pending (1) or finished (0) and count it
+    in the publishes of datacube still to finish. Retries and reruns of a period count once.
+    Returns the publishes of datacube still to finish, None if the mark was already set.
+    """
+    marker = 'pending{}{}{}{}'.format(datacube, activity['tileid'], activity['start'], activity['end'])
+    return services.switch_control_table(marker, 'publish{}'.format(datacube), pending, 1 if pending else -1)
+
+
+def s3_key_exists(services, key, prefix, listings):
+    # Check key in the listing of prefix, listed once and kept in listings
+    if prefix not in listings:
+        listings[prefix] = services.list_keys_S3(prefix)
+    return key in listings[prefix]
+
+
+def upload_quicklook_sidecar(services, file, key):
+    # Quicklook sidecar of the image just written in memory at file, stored next to key
+    with quicklook_sidecar(file) as memfile:
+        services.upload_fileobj_S3(memfile, quicklook_path(key), {'ACL': 'public-read'})
+
+
 ###############################
 # MERGE
 ###############################
-def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata, numcol, numlin, block_size, crs):
+def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata, numcol, numlin, block_size, crs,
+                  functions):
     services = self.services
 
     # Build the basics of the merge activity
@@ -166,6 +210,7 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
     activity['nodata'] = nodata
     activity['block_size'] = block_size
     activity['srs'] = crs
+    activity['functions'] = functions
 
     # For all tiles
     for tileid in self.score['items']:
@@ -177,9 +222,13 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
         activity['tileid'] = tileid
         # GET bounding box - tile ID
         activity['bbox'] = self.score['items'][tileid]['bbox']
+        activity['geom'] = self.score['items'][tileid]['geom']
         activity['xmin'] = self.score['items'][tileid]['xmin']
         activity['ymax'] = self.score['items'][tileid]['ymax']
 
+        # S3 listing of the tile directory, shared by all periods
+        listings = {}
+
         # For all periods
         for periodkey in self.score['items'][tileid]['periods']:
             activity['start'] = self.score['items'][tileid]['periods'][periodkey]['composite_start']
@@ -219,9 +268,13 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
                 services.put_item_kinesis(activity)
                 continue
 
+            # One more publish of the cube to finish, see refresh_asset_view
+            set_pending_publish(services, datacube, activity, 1)
+
             # Build each merge activity
             # For all bands
             activity['list_dates'] = list_dates
+            merges = []
             for band in self.score['items'][tileid]['periods'][periodkey]['scenes']:
                 activity['band'] = band
 
@@ -230,23 +283,15 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
                     activity['dataset'] = dataset
 
                     # get resolution by dataset
-                    if 'LC8SR' in dataset:
-                        activity['resolution'] = '30'
-                    elif dataset == 'CBERS-4_AWFI':
-                        activity['resolution'] = '64'
-                    elif dataset == 'CBERS-4_MUX':
-                        activity['resolution'] = '20'
-                    elif 'S2SR' in dataset:
-                        activity['resolution'] = '10'
-                    elif dataset == 'MOD13Q1':
-                        activity['resolution'] = '231'
-                    elif dataset == 'MYD13Q1':
-                        activity['resolution'] = '231'
+                    decoder = get_qa_decoder(dataset)
+                    if decoder is not None and decoder.resolution is not None:
+                        activity['resolution'] = str(decoder.resolution)
 
                     # For all dates
                     for date in self.score['items'][tileid]['periods'][periodkey]['scenes'][band][dataset]:
                         activity['date'] = date[0:10]
                         activity['links'] = []
+                        activity['overlaps'] = []
 
                         # Create the dynamoKey for the activity in DynamoDB
                         activity['dynamoKey'] = encode_key(activity, ['action','datacube','tileid','date','band'])
@@ -254,6 +299,7 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
                         # Get all scenes that were acquired in the same date
                         for scene in self.score['items'][tileid]['periods'][periodkey]['scenes'][band][dataset][date]:
                             activity['links'].append(scene['link'])
+                            activity['overlaps'].append(scene.get('overlap'))
 
                         # Continue filling the activity
                         activity['ARDfile'] = activity['dirname']+'{}/{}_{}_{}_{}.tif'.format(date[0:10],
@@ -261,23 +307,29 @@ def prepare_merge(self, datacube, datasets, bands, quicklook, resx, resy, nodata
                         activity['sk'] = activity['date'] + activity['dataset']
                         activity['mylaunch'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-                        # Check if we have already done and no need to do it again
-                        response = services.get_activity_item({'id': activity['dynamoKey'], 'sk': activity['sk'] })
-                        if 'Item' in response:
-                            if response['Item']['mystatus'] == 'DONE' \
-                                and services.s3fileExists(key=activity['ARDfile']):
-                                next_step(services, activity)
-                                continue
-                        else:
-                            activity['mystatus'] = 'NOTDONE'
-                            activity['mystart'] = 'SSSS-SS-SS'
-                            activity['myend'] = 'EEEE-EE-EE'
-                            activity['efficacy'] = '0'
-                            activity['cloudratio'] = '100'
-
-                            # Send to queue to activate merge lambda
-                            services.put_item_kinesis(activity)
-                            services.send_to_sqs(activity)
+                        merges.append(dict(activity))
+
+            # Check if we have already done and no need to do it again,
+            # with batch requests to DynamoDB and one S3 listing of the tile
+            items = services.batch_get_activity_items(
+                [{'id': merge_item['dynamoKey'], 'sk': merge_item['sk']} for merge_item in merges])
+            for merge_item in merges:
+                item = items.get((merge_item['dynamoKey'], merge_item['sk']))
+                if item is not None:
+                    if item['mystatus'] == 'DONE' \
+                        and s3_key_exists(services, merge_item['ARDfile'], merge_item['dirname'], listings):
+                        next_step(services, merge_item)
+                    continue
+
+                merge_item['mystatus'] = 'NOTDONE'
+                merge_item['mystart'] = 'SSSS-SS-SS'
+                merge_item['myend'] = 'EEEE-EE-EE'
+                merge_item['efficacy'] = '0'
+                merge_item['cloudratio'] = '100'
+
+                # Send to queue to activate merge lambda
+                services.put_item_kinesis(merge_item)
+                services.send_to_sqs(merge_item)
 
 def merge_warped(self, activity):
     print('==> start MERGE')
@@ -318,99 +370,79 @@ def merge_warped(self, activity):
     block_size = int(activity['block_size'])
     nodata = int(activity['nodata']) if 'nodata' in activity else -9999
     transform = Affine(resx, 0, xmin, 0, -resy, ymax) 
+    merge_mode = activity.get('merge_mode', MERGE_MODE)
+    merge_workers = int(activity.get('merge_workers', MERGE_WORKERS))
+    merge_read = activity.get('merge_read', MERGE_READ)
+    mask_workers = int(activity.get('mask_workers', MASK_WORKERS))
+    mask_chunk_rows = int(activity.get('mask_chunk_rows', MASK_CHUNK_ROWS))
+    qlook_sidecars = bool(int(activity.get('qlook_sidecars', QLOOK_SIDECARS)))
 
     # Quality band is resampled by nearest, other are bilinear
     band = activity['band']
     if band == 'quality':
         resampling = Resampling.nearest
-
-        raster = numpy.zeros((numlin, numcol,), dtype=numpy.uint16)
-        raster_merge = numpy.zeros((numlin, numcol,), dtype=numpy.uint16)
-        raster_mask = numpy.ones((numlin, numcol,), dtype=numpy.uint16)
         nodata = 0
     else: 
         resampling = Resampling.bilinear
-        raster = numpy.zeros((numlin, numcol,), dtype=numpy.int16)
-        raster_merge = numpy.full((numlin, numcol,), fill_value=nodata, dtype=numpy.int16)
-
-    # For all files
-    template = None
-    for url in activity['links']:
-        with rasterio.Env(CPL_CURL_VERBOSE=False):
-            with rasterio.open(url) as src: 
-                kwargs = src.meta.copy() 
-                kwargs.update({ 
-                    'crs': activity['srs'], 
-                    'transform': transform, 
-                    'width': numcol, 
-                    'height': numlin
-                })
-
-                source_nodata = 0
-                
-                if src.profile['nodata'] is not None:
-                    source_nodata = src.profile['nodata']
-                elif 'LC8SR' in dataset:
-                    if band != 'quality':
-                        source_nodata = nodata
-                    else:
-                        source_nodata = 1
-                elif 'CBERS' in dataset and band != 'quality':
-                    source_nodata = nodata
-
-                kwargs.update({
-                    'nodata': source_nodata
-                })
-
-                with MemoryFile() as memfile: 
-                    with memfile.open(**kwargs) as dst: 
-                        reproject(
-                            source=rasterio.band(src, 1), 
-                            destination=raster, 
-                            src_transform=src.transform, 
-                            src_crs=src.crs, 
-                            dst_transform=transform, 
-                            dst_crs=activity['srs'], 
-                            src_nodata=source_nodata, 
-                            dst_nodata=nodata, 
-                            resampling=resampling)
-
-                        if band != 'quality':
-                            valid_data_scene = raster[raster != nodata]
-                            raster_merge[raster != nodata] = valid_data_scene.reshape(numpy.size(valid_data_scene))
-                        else:
-                            raster_merge = raster_merge + raster * raster_mask
-                            raster_mask[raster != nodata] = 0
-
-                        if template is None:
-                            template = dst.profile
-                            if band != 'quality':
-                                template['dtype'] = 'int16'
-                                template['nodata'] = nodata
-
-    # Evaluate cloud cover and efficacy if band is quality
+
+    cog_options = {
+        'compress': 'LZW',
+        'tiled': True,
+        'interleave': 'pixel',
+        'blockxsize': block_size,
+        'blockysize': block_size
+    }
+
     efficacy = 0
     cloudratio = 100
-    if activity['band'] == 'quality':
-        raster_merge, efficacy, cloudratio = getMask(raster_merge, dataset)
-        template.update({'dtype': 'uint16'})
-
-    # Save merged image on S3
     with MemoryFile() as memfile:
-        template.update({
-            'compress': 'LZW',
-            'tiled': True,
-            'interleave': 'pixel',
-            'blockxsize': block_size,
-            'blockysize': block_size
-        })  
-        with memfile.open(**template) as riodataset:
-            riodataset.nodata = nodata
-            riodataset.write_band(1, raster_merge)
-            riodataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
-            riodataset.update_tags(ns='rio_overview', resampling='nearest')
+        # Block streaming mode writes each merged window straight into the output file.
+        # Quality band still needs the full merged array to evaluate the cloud mask
+        if merge_mode == 'window' and band != 'quality':
+            template = get_merge_template_from_links(activity['links'], dataset, band,
+                activity['srs'], transform, numcol, numlin, nodata)
+            template.update(cog_options)
+            with memfile.open(**template) as riodataset:
+                riodataset.nodata = nodata
+                merge_windowed(activity['links'], dataset, band, activity['srs'], transform,
+                    numcol, numlin, nodata, resampling, block_size,
+                    lambda window, data: riodataset.write(data, window=window, indexes=1),
+                    workers=merge_workers, read=merge_read)
+                riodataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
+                riodataset.update_tags(ns='rio_overview', resampling='nearest')
+        else:
+            if merge_mode == 'window':
+                raster_merge = numpy.zeros((numlin, numcol,), dtype=numpy.uint16)
+
+                def write_window(window, data):
+                    raster_merge[window.toslices()] = data
+
+                template = merge_windowed(activity['links'], dataset, band, activity['srs'], transform,
+                    numcol, numlin, nodata, resampling, block_size, write_window,
+                    workers=merge_workers, read=merge_read)
+            else:
+                raster_merge, template = merge_full(activity['links'], dataset, band, activity['srs'],
+                    transform, numcol, numlin, nodata, resampling,
+                    workers=merge_workers, read=merge_read)
+
+            # Evaluate cloud cover and efficacy if band is quality
+            if band == 'quality':
+                raster_merge, efficacy, cloudratio = getMask(raster_merge, dataset, mask_workers, mask_chunk_rows)
+                template.update({'dtype': 'uint16'})
+
+            # Save merged image on S3
+            template.update(cog_options)
+            with memfile.open(**template) as riodataset:
+                riodataset.nodata = nodata
+                riodataset.write_band(1, raster_merge)
+                riodataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
+                riodataset.update_tags(ns='rio_overview', resampling='nearest')
         services.upload_fileobj_S3(memfile, key, {'ACL': 'public-read'})
 
+        # Quicklook band of the merged image, while it is in memory
+        if qlook_sidecars and band in activity['quicklook'].split(','):
+            upload_quicklook_sidecar(services, memfile.name, key)
+
     # Update entry in DynamoDB
     myend = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     activity['myend'] = myend
@@ -435,6 +467,7 @@ def next_blend(services, mergeactivity):
     blendactivity['datacube'] = mergeactivity['datacube_orig_name']
     for key in ['datasets','bands','quicklook','xmin','ymax','srs','tileid','start','end','dirname','nodata']:
         blendactivity[key] = mergeactivity[key]
+    blendactivity['functions'] = mergeactivity.get('functions', get_functions(DEFAULT_FUNCTIONS))
     blendactivity['totalInstancesToBeDone'] = len(blendactivity['bands'])-1
     
     # Create  dynamoKey for the blendactivity record
@@ -463,23 +496,33 @@ def next_blend(services, mergeactivity):
         services.put_item_kinesis(blendactivity)
         return False
         
-    # Fill the blendactivity fields with data for the other bands from the DynamoDB merge records (quality band is not a blend entry in DynamoDB)
-    for band in blendactivity['bands']:
-        if band == 'quality': continue
+    # Multi-band mode sends the bands to be done to a single blend activity
+    blend_mode = mergeactivity.get('blend_mode', BLEND_MODE)
+    blend_bands = []
+    blend_files = {}
 
+    # Blend records of all bands, in a single batch request
+    bands = [band for band in blendactivity['bands'] if band != 'quality']
+    items = services.batch_get_activity_items(
+        [{'id': blendactivity['dynamoKey'], 'sk': band} for band in bands])
+    listings = {}
+
+    # Fill the blendactivity fields with data for the other bands from the DynamoDB merge records (quality band is not a blend entry in DynamoDB)
+    for band in bands:
         mergeactivity['band'] = band
         blendactivity['band'] = band
         blendactivity['sk'] = band
         _ = fill_blend(services, mergeactivity, blendactivity)
 
         # Check if we are doing it again and if we have to do it because a different number of ARDfiles is present
-        response = services.get_activity_item({'id': blendactivity['dynamoKey'], 'sk': band })
-
-        if 'Item' in response \
-                and response['Item']['mystatus'] == 'DONE' \
-                and response['Item']['instancesToBeDone'] == blendactivity['instancesToBeDone'] \
-                and services.s3fileExists(key=blendactivity['MEDfile']) \
-                and services.s3fileExists(key=blendactivity['STKfile']):
+        item = items.get((blendactivity['dynamoKey'], band))
+
+        if item is not None \
+                and item['mystatus'] == 'DONE' \
+                and item['instancesToBeDone'] == blendactivity['instancesToBeDone'] \
+                and all(s3_key_exists(services, blendactivity['{}file'.format(function)],
+                    os.path.dirname(blendactivity['{}file'.format(function)]) + '/', listings)
+                    for function in blendactivity['functions']):
             blendactivity['mystatus'] = 'DONE'
             next_step(services, blendactivity)
             continue
@@ -497,12 +540,27 @@ def next_blend(services, mergeactivity):
         key = '{}activities/{}.json'.format(blendactivity['dirname'], blendactivity['dynamoKey'])
         services.save_file_S3(key, blendactivity)
         services.put_item_kinesis(blendactivity)
+
+        # The ARDfiles of the band are kept in blendactivity for the multi-band blend
+        if blend_mode == 'multiband':
+            blend_bands.append(band)
+            blend_files[band] = dict(('{}file'.format(function), blendactivity['{}file'.format(function)])
+                for function in blendactivity['functions'])
+            continue
+
         services.send_to_sqs(blendactivity)
         
         # Leave room for next band in blendactivity
         for datedataset in blendactivity['scenes']:
             if band in blendactivity['scenes'][datedataset]['ARDfiles']:
                 del blendactivity['scenes'][datedataset]['ARDfiles'][band]
+
+    if blend_bands:
+        blendactivity['band'] = blend_bands[0]
+        blendactivity['sk'] = blend_bands[0]
+        blendactivity['blend_bands'] = blend_bands
+        blendactivity['blend_files'] = blend_files
+        services.send_to_sqs(blendactivity)
     return True
 
 def fill_blend(services, mergeactivity, blendactivity):
@@ -535,6 +593,7 @@ def fill_blend(services, mergeactivity, blendactivity):
             blendactivity['scenes'][datedataset]['raster_size_y'] = activity.get('raster_size_y')
             blendactivity['scenes'][datedataset]['block_size'] = activity.get('block_size')
             blendactivity['scenes'][datedataset]['resolution'] = activity['resolution']
+            blendactivity['scenes'][datedataset]['overlap'] = get_date_overlap(activity.get('overlaps'))
         if 'ARDfiles' not in blendactivity['scenes'][datedataset]:
             blendactivity['scenes'][datedataset]['ARDfiles'] = {}
         basename = os.path.basename(activity['ARDfile'])
@@ -542,35 +601,72 @@ def fill_blend(services, mergeactivity, blendactivity):
     
     blendactivity['instancesToBeDone'] += len(items)
     if band != 'quality':
-        for function in ['MED', 'STK']:
+        for function in blendactivity['functions']:
             cube_id = '{}_{}'.format(blendactivity['datacube'], function)
             blendactivity['{}file'.format(function)] = '{0}/{1}/{2}_{3}/{0}_{1}_{2}_{3}_{4}.tif'.format(
                 cube_id, blendactivity['tileid'], blendactivity['start'], blendactivity['end'], band)
     return True
 
+def blend_band_activities(activity, bands):
+    # Activity of each band of a blend, multi-band blends have the output files of each band in blend_files
+    for band in bands:
+        band_activity = dict(activity)
+        band_activity.pop('blend_bands', None)
+        band_activity.pop('blend_files', None)
+        band_activity['band'] = band
+        band_activity['sk'] = band
+        band_activity.update(activity.get('blend_files', {}).get(band, {}))
+        yield band_activity
+
 def blend(self, activity):
     print('==> start BLEND')
     services = self.services
 
     activity['mystart'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     activity['sk'] = activity['band']
-    band = activity['band']
+    # Multi-band blends composite all bands in blend_bands in the same pass
+    bands = activity.get('blend_bands', [activity['band']])
+    band_activities = list(blend_band_activities(activity, bands))
     numscenes = len(activity['scenes'])
     nodata = activity.get('nodata', -9999)
+    blend_workers = int(activity.get('blend_workers', BLEND_WORKERS))
+    blend_median = activity.get('blend_median', BLEND_MEDIAN)
+    blend_prefetch = int(activity.get('blend_prefetch', BLEND_PREFETCH))
+    blend_prefetch_mb = int(activity.get('blend_prefetch_mb', BLEND_PREFETCH_MB))
+    blend_readers = int(activity.get('blend_readers', BLEND_READERS))
+    blend_read_mb = int(activity.get('blend_read_mb', BLEND_READ_MB))
+    blend_provenance = bool(int(activity.get('blend_provenance', BLEND_PROVENANCE)))
+    qlook_sidecars = bool(int(activity.get('qlook_sidecars', QLOOK_SIDECARS)))
+    qlbands = activity['quicklook'].split(',')
+    # Composite functions of the cube, all computed from the same reads.
+    # STACK is always evaluated, the cloudratio comes from it
+    functions = activity.get('functions', get_functions(DEFAULT_FUNCTIONS))
+    blend_functions = functions + [function for function in ['STK'] if function not in functions]
+    # AVG, MIN and MAX need the stack of the band, they fall back to the median by sort, as do
+    # short time series and reads ahead (they load all scenes of a window anyway)
+    if blend_median == 'histogram' and (not set(blend_functions) <= set(HISTOGRAM_FUNCTIONS)
+                                        or numscenes < HISTOGRAM_MIN_SCENES
+                                        or blend_prefetch > 0 or blend_read_mb > 0):
+        blend_median = 'sort'
+
+    def put_status(mystatus):
+        for band_activity in band_activities:
+            band_activity['mystatus'] = mystatus
+            services.put_item_kinesis(band_activity)
 
     # Check if band ARDfiles are in activity
     for datedataset in activity['scenes']:
-        if band not in activity['scenes'][datedataset]['ARDfiles']:
-            activity['mystatus'] = 'ERROR band {}'.format(band)
-            services.put_item_kinesis(activity)
-            return
+        for band in bands:
+            if band not in activity['scenes'][datedataset]['ARDfiles']:
+                put_status('ERROR band {}'.format(band))
+                return
 
     # Get basic information (profile) of input files
     keys = list(activity['scenes'].keys())
     filename = os.path.join(
         services.prefix + activity['dirname'], 
         activity['scenes'][keys[0]]['date'], 
-        activity['scenes'][keys[0]]['ARDfiles'][band])
+        activity['scenes'][keys[0]]['ARDfiles'][bands[0]])
     tilelist = []
     profile = None
     with rasterio.open(filename) as src:
@@ -591,137 +687,272 @@ def blend(self, activity):
         resolution = int(scene['resolution'])
         mask_tuples.append((100.*efficacy/resolution,key))
 
-    # Open all input files and save the datasets in two lists, one for masks and other for the current band.
+    # Open all input files and save the datasets in two lists, one for masks and other for the bands.
     # The list will be ordered by efficacy/resolution
     masklist = []
     bandlist = []
-    for m in sorted(mask_tuples, reverse=True):
-        key = m[1]
-        efficacy = m[0]
-        scene = activity['scenes'][key]
-
-        # MASK -> Quality
-        filename = os.path.join(
-            services.prefix + activity['dirname'],
-            scene['date'],
-            scene['ARDfiles']['quality'])
-        try:
+    scene_keys = []
+    try:
+        for m in sorted(mask_tuples, reverse=True):
+            key = m[1]
+            efficacy = m[0]
+            scene = activity['scenes'][key]
+            scene_keys.append(key)
+
+            # MASK -> Quality
+            filename = os.path.join(
+                services.prefix + activity['dirname'],
+                scene['date'],
+                scene['ARDfiles']['quality'])
             masklist.append(rasterio.open(filename))
-        except:
-            activity['mystatus'] = 'ERROR {}'.format(os.path.basename(filename))
-            services.put_item_kinesis(activity)
-            return
-
-        # BANDS
-        filename = os.path.join(
-            services.prefix + activity['dirname'],
-            scene['date'],
-            scene['ARDfiles'][band])
-        try:
-            bandlist.append(rasterio.open(filename))
-        except:
-            activity['mystatus'] = 'ERROR {}'.format(os.path.basename(filename))
-            services.put_item_kinesis(activity)
-            return
+
+            # BANDS
+            bandlist.append({})
+            for band in bands:
+                filename = os.path.join(
+                    services.prefix + activity['dirname'],
+                    scene['date'],
+                    scene['ARDfiles'][band])
+                bandlist[-1][band] = rasterio.open(filename)
+    except:
+        put_status('ERROR {}'.format(os.path.basename(filename)))
+        return
 
     # Build the raster to store the output images.		
     width = profile['width']
     height = profile['height']
 
-    # STACK will be generated in memory
-    stack_raster = numpy.zeros((height,width), dtype=profile['dtype'])
-    mask_raster = numpy.ones((height,width), dtype=profile['dtype'])
-
-    # create file to save count no cloud
-    build_cnc = activity['bands'][0] == band
-    if build_cnc:
-        cloud_cloud_file = '/tmp/cnc.tif'
-        count_cloud_dataset = rasterio.open(cloud_cloud_file, mode='w', **profile)
-
-    with MemoryFile() as medianfile:
-        with medianfile.open(**profile) as mediandataset:
-            for _, window in tilelist:
-                # Build the stack to store all images as a masked array. At this stage the array will contain the masked data	
-                stackMA = numpy.ma.zeros((numscenes, window.height, window.width), dtype=numpy.int16)
-
-                notdonemask = numpy.ones(shape=(window.height,window.width),dtype=numpy.bool_)
-
-                # For all pair (quality,band) scenes 
-                for order in range(numscenes):
-                    ssrc = bandlist[order]
-                    msrc = masklist[order]
-                    raster = ssrc.read(1, window=window)
-                    mask = msrc.read(1, window=window)
-                    mask[mask != 1] = 0
-
-                    # True => nodata
-                    bmask = numpy.invert(mask.astype(numpy.bool_))
-
-                    # Use the mask to mark the fill (0) and cloudy (2) pixels
-                    stackMA[order] = numpy.ma.masked_where(bmask, raster)
-
-                    # Evaluate the STACK image
-                    # Pixels that have been already been filled by previous rasters will be masked in the current raster
-                    mask_raster[window.row_off : window.row_off+window.height, window.col_off : window.col_off+window.width] *= bmask.astype(profile['dtype'])
-                    
-                    raster[raster == nodata] = 0
-                    todomask = notdonemask * numpy.invert(bmask)
-                    notdonemask = notdonemask * bmask
-                    stack_raster[window.row_off : window.row_off+window.height, window.col_off : window.col_off+window.width] += (todomask * raster.astype(profile['dtype']))
-
-                median_raster = numpy.ma.median(stackMA, axis=0).data
-                median_raster[notdonemask.astype(numpy.bool_)] = nodata
-                mediandataset.write(median_raster.astype(profile['dtype']), window=window, indexes=1)
-
-                if build_cnc:
-                    count_raster = numpy.ma.count(stackMA, axis=0)
-                    count_cloud_dataset.write(count_raster.astype(profile['dtype']), window=window, indexes=1)
-
-            stack_raster[mask_raster.astype(numpy.bool_)] = nodata
-
-            if band != 'quality':
-                mediandataset.nodata = nodata
-            mediandataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
-            mediandataset.update_tags(ns='rio_overview', resampling='nearest')
-
-        services.upload_fileobj_S3(medianfile, activity['MEDfile'], {'ACL': 'public-read'})
-
-    # Close all input dataset
-    for order in range(numscenes):
-        bandlist[order].close()
-        masklist[order].close()
-
-    # Evaluate cloudcover
-    cloudcover = 100. * ((height * width - numpy.count_nonzero(stack_raster)) / (height * width))
-    activity['cloudratio'] = int(cloudcover)
-    activity['raster_size_y'] = height
-    activity['raster_size_x'] = width
-
-    # Upload the CNC dataset
-    if build_cnc:
-        count_cloud_dataset.close()
-        count_cloud_dataset = None
-
-        key_cnc_med = '_'.join(activity['MEDfile'].split('_')[:-1]) + '_cnc.tif'
-        key_cnc_stk = '_'.join(activity['STKfile'].split('_')[:-1]) + '_cnc.tif'
-        services.upload_file_S3(cloud_cloud_file, key_cnc_med, {'ACL': 'public-read'})
-        services.upload_file_S3(cloud_cloud_file, key_cnc_stk, {'ACL': 'public-read'})
-        os.remove(cloud_cloud_file)
-
-    # Create and upload the STACK dataset
-    with MemoryFile() as memfile:
-        with memfile.open(**profile) as ds_stack:
-            if band != 'quality':
-                ds_stack.nodata = nodata
-            ds_stack.write_band(1, stack_raster)
-            ds_stack.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
-            ds_stack.update_tags(ns='rio_overview', resampling='nearest')
-        services.upload_fileobj_S3(memfile, activity['STKfile'], {'ACL': 'public-read'})
+    # Pixels with value 0 in the STACK of each band, for the cloudcover
+    stack_zeros = dict((band, 0) for band in bands)
+
+    # Count no cloud is built with the first band of the cube
+    build_cnc = activity['bands'][0] in bands
+    # Source scene of the STACK pixels, the same for all bands, also with the first band
+    build_provenance = blend_provenance and build_cnc and 'STK' in functions
+
+    with ExitStack() as files:
+        # Composites (MEDIAN, STACK ...) and CNC outputs are written window by window
+        outputs = {}
+        for band in bands:
+            for function in functions:
+                memfile = files.enter_context(MemoryFile())
+                outputs[(band, function)] = (memfile, files.enter_context(memfile.open(**profile)))
+        if build_cnc:
+            memfile = files.enter_context(MemoryFile())
+            outputs[(None, 'cnc')] = (memfile, files.enter_context(memfile.open(**profile)))
+        if build_provenance:
+            memfile = files.enter_context(MemoryFile())
+            outputs[(None, 'src')] = (memfile, files.enter_context(memfile.open(**dict(profile, dtype='int16'))))
+
+        # Windows are composited by the blend workers, results are written here in order
+        scenes = list(zip(bandlist, masklist))
+        windows = [window for _, window in tilelist]
+        timing = PipelineTiming()
+        for window, (results, count_raster, index_raster) in blend_windows(
+                scenes, bands, windows, nodata, profile['dtype'], functions=blend_functions,
+                workers=blend_workers, median=blend_median, prefetch=blend_prefetch,
+                prefetch_bytes=blend_prefetch_mb * 1024 * 1024, readers=blend_readers,
+                coalesce_bytes=blend_read_mb * 1024 * 1024, provenance=build_provenance, timing=timing):
+            for band, composites in results.items():
+                for function in functions:
+                    outputs[(band, function)][1].write(composites[function], window=window, indexes=1)
+                stack_raster = composites['STK']
+                stack_zeros[band] += stack_raster.size - numpy.count_nonzero(stack_raster)
+
+            if build_cnc:
+                outputs[(None, 'cnc')][1].write(count_raster.astype(profile['dtype']), window=window, indexes=1)
+            if build_provenance:
+                outputs[(None, 'src')][1].write(index_raster, window=window, indexes=1)
+
+        print('blend {} {} - {}'.format(activity['dynamoKey'], ','.join(bands), timing.report()))
+
+        # Close all input dataset
+        for order in range(numscenes):
+            for ssrc in bandlist[order].values():
+                ssrc.close()
+            masklist[order].close()
+
+        for band_activity in band_activities:
+            band = band_activity['band']
+            for function in functions:
+                memfile, dataset = outputs[(band, function)]
+                if band != 'quality':
+                    dataset.nodata = nodata
+                dataset.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
+                dataset.update_tags(ns='rio_overview', resampling='nearest')
+                dataset.close()
+                services.upload_fileobj_S3(memfile, band_activity['{}file'.format(function)], {'ACL': 'public-read'})
+                if qlook_sidecars and band in qlbands:
+                    upload_quicklook_sidecar(services, memfile.name, band_activity['{}file'.format(function)])
+
+            # Evaluate cloudcover
+            cloudcover = 100. * (stack_zeros[band] / (height * width))
+            band_activity['cloudratio'] = int(cloudcover)
+            band_activity['raster_size_y'] = height
+            band_activity['raster_size_x'] = width
+
+        # Upload the CNC dataset
+        if build_cnc:
+            memfile, dataset = outputs[(None, 'cnc')]
+            dataset.close()
+
+            # One copy for each composite cube
+            cnc_activity = band_activities[bands.index(activity['bands'][0])]
+            for function in functions:
+                key_cnc = '_'.join(cnc_activity['{}file'.format(function)].split('_')[:-1]) + '_cnc.tif'
+                memfile.seek(0)
+                services.upload_fileobj_S3(memfile, key_cnc, {'ACL': 'public-read'})
+
+        # Upload the index of the source scene of the STACK, scenes listed in the tags
+        if build_provenance:
+            memfile, dataset = outputs[(None, 'src')]
+            dataset.nodata = nodata
+            dataset.update_tags(scenes=','.join(scene_keys))
+            dataset.close()
+
+            src_activity = band_activities[bands.index(activity['bands'][0])]
+            key_src = '_'.join(src_activity['STKfile'].split('_')[:-1]) + '_src.tif'
+            services.upload_fileobj_S3(memfile, key_src, {'ACL': 'public-read'})
+
+    for band_activity in band_activities:
+        # Update status and end time in DynamoDB
+        band_activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        band_activity['mystatus'] = 'DONE'
+        services.put_item_kinesis(band_activity)
 
-    # Update status and end time in DynamoDB
-    activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    activity['mystatus'] = 'DONE'
-    services.put_item_kinesis(activity)
+
+###############################
+# CATALOG
+###############################
+# Band ids by common name of each cube, loaded once per process
+BAND_IDS = {}
+# Key of the dirty publishes and last refresh of the asset view in the control table
+ASSET_MV_KEY = 'AssetMV'
+# Whether each materialized view has a unique index, checked once per process
+UNIQUE_INDEXES = {}
+
+
+def get_band_id(cube_id, band):
+    # Id of the band of a cube (None if the cube has no such band), the bands of the cube are
+    # queried again the first time a band is not known
+    if band not in BAND_IDS.get(cube_id, {}):
+        BAND_IDS[cube_id] = dict((str(b.common_name), b.id) for b in Band.query().filter(
+            Band.collection_id == cube_id
+        ).all())
+        BAND_IDS[cube_id].setdefault(band, None)
+    return BAND_IDS[cube_id][band]
+
+
+def get_cubes(cube_ids):
+    # Collections of cube_ids by id, in one query
+    cubes = Collection.query().filter(
+        Collection.id.in_(cube_ids)
+    ).all()
+    return dict((cube.id, cube) for cube in cubes)
+
+
+def has_unique_index(session, name):
+    # REFRESH CONCURRENTLY needs a unique index on the view
+    if name not in UNIQUE_INDEXES:
+        UNIQUE_INDEXES[name] = session.execute(text(
+            "SELECT 1 FROM pg_indexes WHERE tablename = :name AND indexdef LIKE 'CREATE UNIQUE INDEX%'"
+        ), {'name': name}).first() is not None
+    return UNIQUE_INDEXES[name]
+
+
+def refresh_view(session, name):
+    """
+    Refresh the materialized view name, concurrently (the view is still read while it runs)
+    when it has a unique index, and again without it when the concurrent refresh fails.
+    Errors are only logged, returns whether the view was refreshed.
+    """
+    modes = [True, False] if has_unique_index(session, name) else [False]
+    for concurrently in modes:
+        try:
+            refresh_materialized_view(session, name, concurrently=concurrently)
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            print('refresh {} - Error{}: {}'.format(name, ' concurrently' if concurrently else '', e))
+    return False
+
+
+def refresh_asset_view(services, activity):
+    """
+    Record a finished publish of activity['datacube'] and refresh the asset materialized view
+    when it is the last publish of the cube builds, or when the last refresh is at least
+    MV_REFRESH_INTERVAL seconds old. Publishes in between only leave the view dirty, until
+    the next publish or the scheduled flush_asset_view. Periods ending without a publish
+    (no scenes, errors) keep their pending mark, see set_pending_publish.
+    """
+    interval = int(activity.get('mv_refresh_interval', MV_REFRESH_INTERVAL))
+    response = services.update_control_table(
+        Key = {'id': ASSET_MV_KEY},
+        UpdateExpression = "ADD #mycount :increment",
+        ExpressionAttributeNames = {'#mycount': 'mycount'},
+        ExpressionAttributeValues = {':increment': 1},
+        ReturnValues = "UPDATED_NEW"
+    )
+    dirty = int(response['Attributes']['mycount'])
+
+    pending = set_pending_publish(services, activity['datacube'], activity, 0)
+    last = pending is not None and pending <= 0
+    return flush_asset_view(services, 0 if last else interval, dirty)
+
+
+def flush_asset_view(services, interval=MV_REFRESH_INTERVAL, dirty=None):
+    """
+    Refresh the asset materialized view when it has dirty publishes and the last refresh is
+    at least interval seconds old, whatever the publishes still to finish. Runs on a schedule
+    too, so the last publishes of a cube whose count never reaches 0 (e.g. a merge in the DLQ
+    or a period that failed) are refreshed. A failed refresh does not fail the caller, the view stays dirty.
+    """
+    if dirty is None:
+        dirty = int(services.get_control_item(ASSET_MV_KEY).get('mycount', 0))
+    if dirty <= 0 or not services.claim_control_table(ASSET_MV_KEY, int(time.time()), interval):
+        return False
+
+    if not refresh_view(db.session, AssetMV.__table__.name):
+        services.release_control_table(ASSET_MV_KEY)
+        return False
+
+    # Publishes recorded after the count was read are still dirty
+    services.update_control_table(
+        Key = {'id': ASSET_MV_KEY},
+        UpdateExpression = "ADD #mycount :increment",
+        ExpressionAttributeNames = {'#mycount': 'mycount'},
+        ExpressionAttributeValues = {':increment': -dirty},
+        ReturnValues = "NONE"
+    )
+    return True
+
+
+def register_items(items, assets):
+    """
+    Register the CollectionItems `items` and their Assets `assets` (lists of column values) in
+    one transaction: items are upserted by id and all assets of the items are replaced.
+    """
+    if not items:
+        return
+
+    session = db.session()
+    try:
+        session.query(Asset).filter(
+            Asset.collection_item_id.in_([item['id'] for item in items])
+        ).delete(synchronize_session=False)
+
+        statement = insert(CollectionItem.__table__).values(items)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['id'],
+            set_=dict((column, statement.excluded[column]) for column in items[0] if column != 'id')))
+
+        if assets:
+            session.execute(insert(Asset.__table__).values(assets))
+        session.commit()
+    except:
+        session.rollback()
+        raise
 
 
 ###############################
@@ -733,6 +964,7 @@ def next_publish(services, blendactivity):
     for key in ['datacube','datasets','bands','quicklook','xmin','ymax','srs','tileid','start','end', \
         'dirname', 'cloudratio', 'raster_size_x', 'raster_size_y', 'chunk_size_x', 'chunk_size_y']:
         publishactivity[key] = blendactivity.get(key)
+    publishactivity['functions'] = blendactivity.get('functions', get_functions(DEFAULT_FUNCTIONS))
     publishactivity['action'] = 'publish'
 
     # Create  dynamoKey for the publish activity 
@@ -765,8 +997,8 @@ def next_publish(services, blendactivity):
 
         # Get blended files
         publishactivity['blended'][band] = {}
-        publishactivity['blended'][band]['MEDfile'] = activity['MEDfile']
-        publishactivity['blended'][band]['STKfile'] = activity['STKfile']
+        for function in publishactivity['functions']:
+            publishactivity['blended'][band]['{}file'.format(function)] = activity['{}file'.format(function)]
 
     publishactivity['sk'] = 'ALLBANDS'
     publishactivity['mystatus'] = 'NOTDONE'
@@ -786,12 +1018,31 @@ def publish(self, activity):
     print('==> start PUBLISH')
     services = self.services
 
+    try:
+        published = publish_period(services, activity)
+    except Exception:
+        # The period stays pending, the publishes already recorded may still be refreshed
+        # and an error of the refresh must not hide the one of the publish
+        try:
+            flush_asset_view(services, int(activity.get('mv_refresh_interval', MV_REFRESH_INTERVAL)))
+        except Exception as e:
+            print('publish - Error refreshing {}: {}'.format(AssetMV.__table__.name, e))
+        raise
+
+    if published:
+        refresh_asset_view(services, activity)
+    return published
+
+def publish_period(services, activity):
+    # Quicklooks and catalog of the cubes of a tile/period, returns whether it was published
     activity['mystart'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')   
     warped_cube = '_'.join(activity['datacube'].split('_')[0:2])
 
     # Generate quicklooks for CUBES (MEDIAN, STACK ...) 
     qlbands = activity['quicklook'].split(',')
-    for function in ['MED', 'STK']:
+    functions = activity.get('functions', get_functions(DEFAULT_FUNCTIONS))
+    quicklooks = []
+    for function in functions:
         cube_id = get_cube_id(activity['datacube'], function)
         general_scene_id = '{}_{}_{}_{}'.format(
             cube_id, activity['tileid'], activity['start'], activity['end'])
@@ -800,15 +1051,10 @@ def publish(self, activity):
         for band in qlbands:
             qlfiles.append(services.prefix + activity['blended'][band][function + 'file'])
 
-        pngname = generateQLook(general_scene_id, qlfiles)
         dirname_ql = activity['dirname'].replace(
             '{}/'.format(warped_cube), '{}/'.format(cube_id))
-        if pngname is None:
-            print('publish - Error generateQLook for {}'.format(general_scene_id))
-            return False
-        s3pngname = os.path.join(dirname_ql, '{}_{}'.format(activity['start'], activity['end']), os.path.basename(pngname))
-        services.upload_file_S3(pngname, s3pngname, {'ACL': 'public-read'})
-        os.remove(pngname)
+        s3pngname = os.path.join(dirname_ql, '{}_{}'.format(activity['start'], activity['end']), '{}.png'.format(general_scene_id))
+        quicklooks.append((general_scene_id, qlfiles, s3pngname))
 
     # Generate quicklooks for all ARD scenes (WARPED)
     for datedataset in activity['scenes']:
@@ -822,20 +1068,38 @@ def publish(self, activity):
             filename = os.path.join(services.prefix + activity['dirname'], str(scene['date'])[0:10], scene['ARDfiles'][band])
             qlfiles.append(filename)
 
-        pngname = generateQLook(general_scene_id, qlfiles)
-        if pngname is None:
+        s3pngname = os.path.join(activity['dirname'], str(scene['date'])[0:10], '{}.png'.format(general_scene_id))
+        quicklooks.append((general_scene_id, qlfiles, s3pngname))
+
+    # Render the quicklooks in a thread pool, streaming each PNG to S3 from memory.
+    # Bands with a quicklook sidecar, written by merge and blend, are not read again
+    qlook_sidecars = bool(int(activity.get('qlook_sidecars', QLOOK_SIDECARS)))
+
+    def upload_quicklook(quicklook):
+        # Returns the general_scene_id of a quicklook that failed
+        general_scene_id, qlfiles, s3pngname = quicklook
+        try:
+            pngfile = generateQLook(qlfiles, sidecars=qlook_sidecars)
+        except Exception as e:
+            print('publish - generateQLook {}: {}'.format(general_scene_id, e))
+            return general_scene_id
+        services.upload_fileobj_S3(pngfile, s3pngname, {'ACL': 'public-read'})
+
+    for general_scene_id in ordered_map(upload_quicklook, quicklooks,
+                                        int(activity.get('qlook_workers', QLOOK_WORKERS))):
+        if general_scene_id is not None:
             print('publish - Error generateQLook for {}'.format(general_scene_id))
             return False
-        s3pngname = os.path.join(activity['dirname'], str(scene['date'])[0:10], os.path.basename(pngname))
-        services.upload_file_S3(pngname, s3pngname, {'ACL': 'public-read'})
-        os.remove(pngname)
 
-    # register collection_items and assets in DB (MEDIAN, STACK ...)
-    for function in ['MED', 'STK']:
+    # Register collection_items and assets in DB (MEDIAN, STACK ... and the WARPED ARD scenes),
+    # the last ones of repeated ids are kept
+    cube_ids = ['{}_{}'.format(activity['datacube'], function) for function in functions]
+    cubes = get_cubes(cube_ids + [get_cube_id(activity['datacube'])])
+    items = OrderedDict()
+    assets = {}
+    for function in functions:
         cube_id = '{}_{}'.format(activity['datacube'], function)
-        cube = Collection.query().filter(
-            Collection.id == cube_id
-        ).first()
+        cube = cubes.get(cube_id)
         if not cube:
             print('cube {} not found!'.format(cube_id))
             continue
@@ -843,28 +1107,13 @@ def publish(self, activity):
         general_scene_id = '{}_{}_{}_{}'.format(
             cube_id, activity['tileid'], activity['start'], activity['end'])
 
-        # delete collection_items and assets if exists
-        assets = Asset.query().filter(
-            Asset.collection_item_id == general_scene_id
-        ).all()
-        for asset in assets:
-            db.session().delete(asset)
-            db.session().commit()
-
-        coll_item = CollectionItem.query().filter(
-            CollectionItem.id == general_scene_id
-        ).first()
-        if coll_item:
-            db.session().delete(coll_item)
-            db.session().commit()
-
-        # insert 'collection_item'
+        # 'collection_item'
         range_date = '{}_{}'.format(activity['start'], activity['end'])
         png_name = '{}.png'.format(general_scene_id)
         dirname_ql = activity['dirname'].replace(
             '{}/'.format(warped_cube), '{}/'.format(cube_id))
         s3_pngname = os.path.join(dirname_ql, range_date, png_name)
-        CollectionItem(
+        items[general_scene_id] = dict(
             id=general_scene_id,
             collection_id=cube_id,
             grs_schema_id=cube.grs_schema_id,
@@ -876,23 +1125,21 @@ def publish(self, activity):
             cloud_cover=activity['cloudratio'],
             scene_type=function,
             compressed_file=None
-        ).save()
+        )
 
-        # insert 'assets'
-        bands_by_cube = Band.query().filter(
-            Band.collection_id == cube_id
-        ).all()
+        # 'assets'
+        assets[general_scene_id] = []
         for band in activity['bands']:
             if band == 'quality': 
                 continue
-            band_id = list(filter(lambda b: str(b.common_name) == band, bands_by_cube))
-            if not band_id:
+            band_id = get_band_id(cube_id, band)
+            if band_id is None:
                 print('band {} not found!'.format(band))
                 continue
 
-            Asset(
+            assets[general_scene_id].append(dict(
                 collection_id=cube_id,
-                band_id=band_id[0].id,
+                band_id=band_id,
                 grs_schema_id=cube.grs_schema_id,
                 tile_id=activity['tileid'],
                 collection_item_id=general_scene_id,
@@ -904,16 +1151,14 @@ def publish(self, activity):
                 chunk_size_x=activity['chunk_size_x'],
                 chunk_size_y=activity['chunk_size_y'],
                 chunk_size_t=1
-            ).save()
+            ))
 
-    # Register all ARD scenes - WARPED Collection
+    # All ARD scenes - WARPED Collection
     for datedataset in activity['scenes']:
         scene = activity['scenes'][datedataset]
 
         cube_id = get_cube_id(activity['datacube'])
-        cube = Collection.query().filter(
-            Collection.id == cube_id
-        ).first()
+        cube = cubes.get(cube_id)
         if not cube:
             print('cube {} not found!'.format(cube_id))
             continue
@@ -921,25 +1166,10 @@ def publish(self, activity):
         general_scene_id = '{}_{}_{}'.format(
             cube_id, activity['tileid'], str(scene['date'])[0:10])
 
-        # delete 'assets' and 'collection_items' if exists
-        assets = Asset.query().filter(
-            Asset.collection_item_id == general_scene_id
-        ).all()
-        for asset in assets:
-            db.session().delete(asset)
-            db.session().commit()
-
-        coll_item = CollectionItem.query().filter(
-            CollectionItem.id == general_scene_id
-        ).first()
-        if coll_item:
-            db.session().delete(coll_item)
-            db.session().commit()
-
-        # insert 'collection_item'
+        # 'collection_item'
         pngname = '{}.png'.format(general_scene_id)
         s3pngname = os.path.join(activity['dirname'], str(scene['date'])[0:10], pngname)
-        CollectionItem(
+        items[general_scene_id] = dict(
             id=general_scene_id,
             collection_id=cube_id,
             grs_schema_id=cube.grs_schema_id,
@@ -951,27 +1181,25 @@ def publish(self, activity):
             cloud_cover=int(scene['cloudratio']),
             scene_type='WARPED',
             compressed_file=None
-        ).save()
+        )
 
-        # insert 'assets'
-        bands_by_cube = Band.query().filter(
-            Band.collection_id == cube_id
-        ).all()
+        # 'assets'
+        assets[general_scene_id] = []
         for band in activity['bands']:
             if band not in scene['ARDfiles']:
                 print('publish - problem - band {} not in scene[files]'.format(band))
                 continue
-            band_id = list(filter(lambda b: str(b.common_name) == band, bands_by_cube))
-            if not band_id:
+            band_id = get_band_id(cube_id, band)
+            if band_id is None:
                 print('band {} not found!'.format(band))
                 continue
             
             raster_size_x = scene['raster_size_x'] if scene.get('raster_size_x') else activity.get('raster_size_x')
             raster_size_y = scene['raster_size_y'] if scene.get('raster_size_y') else activity.get('raster_size_y')
             block_size = scene['block_size'] if scene.get('block_size') else activity.get('block_size')
-            Asset(
+            assets[general_scene_id].append(dict(
                 collection_id=cube_id,
-                band_id=band_id[0].id,
+                band_id=band_id,
                 grs_schema_id=cube.grs_schema_id,
                 tile_id=activity['tileid'],
                 collection_item_id=general_scene_id,
@@ -983,12 +1211,12 @@ def publish(self, activity):
                 chunk_size_x=block_size,
                 chunk_size_y=block_size,
                 chunk_size_t=1
-            ).save()
+            ))
+
+    register_items(list(items.values()), [asset for item_id in items for asset in assets[item_id]])
 
     # Update status and end time in DynamoDB
     activity['myend'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     activity['mystatus'] = 'DONE'
     services.put_item_kinesis(activity)
-
-    refresh_materialized_view(db.session, AssetMV.__table__)
     return True
\ No newline at end of file
@@ -1,16 +1,69 @@
 import json
+import time
+import threading
 import base64
 import boto3
 import botocore
 import requests
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.errorfactory import ClientError
 from stac import STAC
 
 from config import BUCKET_NAME, DYNAMO_TB_ACTIVITY, DBNAME_TB_CONTROL, \
-    QUEUE_NAME, KINESIS_NAME, URL_STAC, LAMBDA_FUNCTION_NAME, \
-    AWS_KEY_ID, AWS_SECRET_KEY
+    QUEUE_NAME, HEAVY_QUEUE_NAME, KINESIS_NAME, URL_STAC, LAMBDA_FUNCTION_NAME, \
+    AWS_KEY_ID, AWS_SECRET_KEY, STAC_MIN_OVERLAP, DISPATCH_WORKERS, STREAM_BATCH_SIZE, \
+    STREAM_LIGHT_PIXELS
+
+from .utils.builder import get_overlap
+
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+KINESIS_BATCH_SIZE = 500
+KINESIS_BATCH_BYTES = 5 * 1024 * 1024
+DISPATCH_RETRIES = 5
+# longest wait between two retries of a batch
+DISPATCH_MAX_DELAY = 2.
+
+
+class DispatchError(Exception):
+    """Buffered SQS messages or Kinesis records still failing after all retries."""
+
+
+def message_size(message):
+    return len(message.encode('utf-8'))
+
+
+def record_size(record):
+    # Data and partition key count in the Kinesis request limits
+    return len(record['Data'].encode('utf-8')) + len(record['PartitionKey'].encode('utf-8'))
+
+
+def is_light_activity(params):
+    # merges of small tiles (e.g. MODIS) are cheap enough to share an invocation
+    if params.get('action') != 'merge':
+        return False
+    return int(params['numcol']) * int(params['numlin']) <= STREAM_LIGHT_PIXELS
+
+
+def make_batches(messages, max_size, max_bytes, sizeof=message_size):
+    # Group messages in batches limited by number of entries and total size
+    batches = []
+    batch, batch_bytes = [], 0
+    for message in messages:
+        size = sizeof(message)
+        if batch and (len(batch) == max_size or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(message)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
 
 class CubeServices:
     
@@ -26,9 +79,16 @@ class CubeServices:
         self.SQSclient = session.client('sqs')
         self.LAMBDAclient = session.client('lambda')
         self.Kinesisclient = session.client('kinesis')
-        self.dynamoDBResource = session.resource('dynamodb')
+        # boto3 resources are not thread-safe, each worker thread of a batch gets its own
+        self.local = threading.local()
+        self.local.dynamoDBResource = session.resource('dynamodb')
 
         self.QueueUrl = None
+        self.HeavyQueueUrl = None
+        # buffered dispatch of SQS messages and Kinesis records, see dispatch()
+        self.buffering = False
+        self.sqs_buffer = []
+        self.kinesis_buffer = []
         self.prefix = 'https://s3.amazonaws.com/{}/'.format(BUCKET_NAME)
         #self.prefix = 's3//{}/'.format(BUCKET_NAME)
 
@@ -47,18 +107,41 @@ class CubeServices:
     
     ## ----------------------
     # DYNAMO DB
+    @property
+    def dynamoDBResource(self):
+        if not hasattr(self.local, 'dynamoDBResource'):
+            session = boto3.Session(
+                aws_access_key_id=AWS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_KEY)
+            self.local.dynamoDBResource = session.resource('dynamodb')
+        return self.local.dynamoDBResource
+
+    def get_table(self, name):
+        tables = self.local.__dict__.setdefault('tables', {})
+        if name not in tables:
+            tables[name] = self.dynamoDBResource.Table(name)
+        return tables[name]
+
+    @property
+    def activitiesTable(self):
+        return self.get_table(DYNAMO_TB_ACTIVITY)
+
+    @property
+    def activitiesControlTable(self):
+        return self.get_table(DBNAME_TB_CONTROL)
+
     def get_dynamo_tables(self):
         # Create the cubeBuilderActivities table in DynamoDB to store all activities
-        self.activitiesTable = self.dynamoDBResource.Table(DYNAMO_TB_ACTIVITY)
+        activitiesTable = self.dynamoDBResource.Table(DYNAMO_TB_ACTIVITY)
         table_exists = False
         try:
-        	self.activitiesTable.creation_date_time
+        	activitiesTable.creation_date_time
         	table_exists = True
         except:
         	table_exists = False
 
         if not table_exists:
-        	self.activitiesTable = self.dynamoDBResource.create_table(
+        	self.dynamoDBResource.create_table(
         		TableName=DYNAMO_TB_ACTIVITY,
         		KeySchema=[
         			{'AttributeName': 'id', 'KeyType': 'HASH' },
@@ -74,16 +157,16 @@ class CubeServices:
         	self.dynamoDBResource.meta.client.get_waiter('table_exists').wait(TableName=DYNAMO_TB_ACTIVITY)
 
         # Create the cubeBuilderActivitiesControl table in DynamoDB to manage activities completion
-        self.activitiesControlTable = self.dynamoDBResource.Table(DBNAME_TB_CONTROL)
+        activitiesControlTable = self.dynamoDBResource.Table(DBNAME_TB_CONTROL)
         table_exists = False
         try:
-        	self.activitiesControlTable.creation_date_time
+        	activitiesControlTable.creation_date_time
         	table_exists = True
         except:
         	table_exists = False
 
         if not table_exists:
-        	self.activitiesControlTable = self.dynamoDBResource.create_table(
+        	self.dynamoDBResource.create_table(
         		TableName=DBNAME_TB_CONTROL,
         		KeySchema=[
         			{'AttributeName': 'id', 'KeyType': 'HASH' },
@@ -115,6 +198,35 @@ class CubeServices:
             Key=query
         )
 
+    def batch_get_activity_items(self, keys):
+        """
+        Get many activities with BatchGetItem (100 keys per request).
+        Returns a dict of the items found by (id, sk).
+        """
+        # BatchGetItem does not accept repeated keys
+        unique_keys = []
+        seen = set()
+        for key in keys:
+            if (key['id'], key['sk']) not in seen:
+                seen.add((key['id'], key['sk']))
+                unique_keys.append(key)
+
+        items = {}
+        for i in range(0, len(unique_keys), 100):
+            request = {DYNAMO_TB_ACTIVITY: {'Keys': unique_keys[i:i+100]}}
+            attempt = 0
+            while request:
+                response = self.dynamoDBResource.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(DYNAMO_TB_ACTIVITY, []):
+                    items[(item['id'], item['sk'])] = item
+
+                # Keys not processed due throughput limits are requested again
+                request = response.get('UnprocessedKeys')
+                if request:
+                    time.sleep(min(0.05 * 2 ** attempt, 2))
+                    attempt += 1
+        return items
+
     def put_activity(self, activity):
         self.activitiesTable.put_item(
 			Item = {
@@ -142,6 +254,9 @@ class CubeServices:
         )
         return True
 
+    def get_control_item(self, key):
+        return self.activitiesControlTable.get_item(Key={'id': key}, ConsistentRead=True).get('Item', {})
+
     def update_control_table(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues, ReturnValues):
         return self.activitiesControlTable.update_item(
             Key=Key,
@@ -151,24 +266,97 @@ class CubeServices:
             ReturnValues=ReturnValues
         )
 
+    def claim_control_table(self, key, now, interval):
+        # Set the claimed time of key to now if the last claim is at least interval seconds old,
+        # returns if this call claimed it (only one of concurrent calls does)
+        try:
+            self.activitiesControlTable.update_item(
+                Key={'id': key},
+                UpdateExpression='SET #claimed = :now',
+                ConditionExpression='attribute_not_exists(#claimed) OR #claimed <= :limit',
+                ExpressionAttributeNames={'#claimed': 'claimed'},
+                ExpressionAttributeValues={':now': now, ':limit': now - interval}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def release_control_table(self, key):
+        # Clear the claimed time of key, the next claim_control_table succeeds
+        self.activitiesControlTable.update_item(
+            Key={'id': key},
+            UpdateExpression='REMOVE #claimed',
+            ExpressionAttributeNames={'#claimed': 'claimed'}
+        )
+
+    def switch_control_table(self, marker, key, state, count):
+        """
+        Set the state of marker and add count to mycount of key in one transaction, only when
+        the marker is not in that state yet (repeated calls count once).
+        Returns the new mycount of key, None if the marker was already in the state.
+        """
+        client = self.dynamoDBResource.meta.client
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': DBNAME_TB_CONTROL,
+                    'Key': {'id': {'S': marker}},
+                    'UpdateExpression': 'SET #state = :state',
+                    'ConditionExpression': 'attribute_not_exists(#state) OR #state <> :state',
+                    'ExpressionAttributeNames': {'#state': 'mystate'},
+                    'ExpressionAttributeValues': {':state': {'N': str(state)}}
+                }},
+                {'Update': {
+                    'TableName': DBNAME_TB_CONTROL,
+                    'Key': {'id': {'S': key}},
+                    'UpdateExpression': 'ADD #mycount :increment',
+                    'ExpressionAttributeNames': {'#mycount': 'mycount'},
+                    'ExpressionAttributeValues': {':increment': {'N': str(count)}}
+                }}
+            ])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            # Canceled by the condition, or by a conflict when the marker is still in the other state
+            item = self.activitiesControlTable.get_item(Key={'id': marker}, ConsistentRead=True).get('Item', {})
+            if int(item.get('mystate', -1)) != state:
+                raise
+            return None
+
+        item = self.activitiesControlTable.get_item(Key={'id': key}, ConsistentRead=True)['Item']
+        return int(item['mycount'])
+
     ## ----------------------
     # SQS
     def get_queue_url(self):
         if self.QueueUrl is not None:
         	return True
-        response = self.SQSclient.list_queues()
-        q_exists = False
-        if 'QueueUrls' in response:
-        	for qurl in response['QueueUrls']:
-        		if qurl.find(QUEUE_NAME) != -1:
-        			if qurl.find('DLQ') == -1:
-        				q_exists = True
-        				self.QueueUrl = qurl
-        if not q_exists:
-        	self.create_queue(True)
+        self.QueueUrl = self.find_queue_url(QUEUE_NAME)
+        if self.QueueUrl is None:
+        	self.QueueUrl = self.create_queue(QUEUE_NAME, STREAM_BATCH_SIZE, True)
+        # heavy activities have their own queue, one message per invocation
+        if HEAVY_QUEUE_NAME:
+        	self.HeavyQueueUrl = self.find_queue_url(HEAVY_QUEUE_NAME)
+        	if self.HeavyQueueUrl is None:
+        		self.HeavyQueueUrl = self.create_queue(HEAVY_QUEUE_NAME, 1, True)
         return True
 
-    def create_queue(self, create_mapping = False):
+    def find_queue_url(self, name):
+        response = self.SQSclient.list_queues(QueueNamePrefix=name)
+        for qurl in response.get('QueueUrls', []):
+        	if qurl.rsplit('/', 1)[-1] == name:
+        		return qurl
+        return None
+
+    def get_activity_queue_url(self, activity):
+        # Blends, publishes and large merges go to the heavy queue, when there is one
+        if self.HeavyQueueUrl is not None and not is_light_activity(activity):
+        	return self.HeavyQueueUrl
+        return self.QueueUrl
+
+    def create_queue(self, name=QUEUE_NAME, batch_size=STREAM_BATCH_SIZE, create_mapping = False):
         """
         As the influx of messages to a queue increases, AWS Lambda automatically scales up 
         polling activity until the number of concurrent function executions reaches 1000, 
@@ -183,16 +371,16 @@ class CubeServices:
 		"""
         # Create a SQS for this experiment
         response = self.SQSclient.create_queue(
-            QueueName=QUEUE_NAME,
+            QueueName=name,
         	Attributes={'VisibilityTimeout': '500'}
         )
-        self.QueueUrl = response['QueueUrl']
+        QueueUrl = response['QueueUrl']
         # Get attributes
-        attributes = self.SQSclient.get_queue_attributes(QueueUrl=self.QueueUrl, AttributeNames=['All',])
+        attributes = self.SQSclient.get_queue_attributes(QueueUrl=QueueUrl, AttributeNames=['All',])
         QueueArn = attributes['Attributes']['QueueArn']
 
         # Create a DLQ for this experiment
-        response = self.SQSclient.create_queue(QueueName=QUEUE_NAME+'DLQ',
+        response = self.SQSclient.create_queue(QueueName=name+'DLQ',
         	Attributes={
         		'VisibilityTimeout': '500'
         		}
@@ -208,7 +396,7 @@ class CubeServices:
 
         # Configure queue to send messages to dead letter queue
         self.SQSclient.set_queue_attributes(
-        	QueueUrl=self.QueueUrl,
+        	QueueUrl=QueueUrl,
         	Attributes={
         		'RedrivePolicy': json.dumps(redrive_policy)
         	}
@@ -219,12 +407,30 @@ class CubeServices:
         		EventSourceArn=QueueArn,
         		FunctionName=LAMBDA_FUNCTION_NAME,
         		Enabled=True,
-        		BatchSize=1
+        		BatchSize=batch_size,
+        		FunctionResponseTypes=['ReportBatchItemFailures']
         	)
+        return QueueUrl
 
     def send_to_sqs(self, activity):
         if self.get_queue_url():
-            self.SQSclient.send_message(QueueUrl=self.QueueUrl, MessageBody=json.dumps(activity))
+            queue_url = self.get_activity_queue_url(activity)
+            if self.buffering:
+                self.sqs_buffer.append((queue_url, json.dumps(activity)))
+                return
+            self.SQSclient.send_message(QueueUrl=queue_url, MessageBody=json.dumps(activity))
+
+    def send_batch_sqs(self, queue_url, messages):
+        # Send up to 10 messages, retrying only the entries that failed
+        entries = [{'Id': str(i), 'MessageBody': body} for i, body in enumerate(messages)]
+        for attempt in range(DISPATCH_RETRIES):
+            response = self.SQSclient.send_message_batch(QueueUrl=queue_url, Entries=entries)
+            failed = set(f['Id'] for f in response.get('Failed', []))
+            entries = [e for e in entries if e['Id'] in failed]
+            if not entries:
+                return []
+            time.sleep(min(0.1 * 2 ** attempt, DISPATCH_MAX_DELAY))
+        return [entry['MessageBody'] for entry in entries]
 
     
     ## ----------------------
@@ -238,13 +444,90 @@ class CubeServices:
         return status
 
     def sendToKinesis(self, activity):
+        # Records are spread over the shards by the key of their activity
+        record = {'Data': json.dumps(activity), 'PartitionKey': activity.get('dynamoKey') or 'dsKinesis'}
+        if self.buffering:
+            self.kinesis_buffer.append(record)
+            return True
         self.Kinesisclient.put_record(
 			StreamName=KINESIS_NAME,
-			Data=json.dumps(activity),
-    		PartitionKey='dsKinesis'
+			Data=record['Data'],
+    		PartitionKey=record['PartitionKey']
 		)
         return True
 
+    def send_batch_kinesis(self, entries, retries=DISPATCH_RETRIES):
+        # Put up to 500 records, retrying only the records that failed (usually throttled by the shard)
+        for attempt in range(retries):
+            response = self.Kinesisclient.put_records(StreamName=KINESIS_NAME, Records=entries)
+            if response.get('FailedRecordCount', 0) == 0:
+                return []
+            entries = [entry for entry, result in zip(entries, response['Records']) if 'ErrorCode' in result]
+            time.sleep(min(0.1 * 2 ** attempt, DISPATCH_MAX_DELAY))
+        return entries
+
+
+    ## ----------------------
+    # Buffered dispatch
+    @contextmanager
+    def dispatch(self):
+        """
+        Buffer send_to_sqs and put_item_kinesis calls and send them in batches when the block ends.
+        If the block raises, the buffered messages are discarded and the error goes on. When
+        messages or records still fail after all retries, DispatchError is raised listing the
+        keys of their activities, so the lambda (or its queue message) is retried.
+
+        with services.dispatch():
+            prepare_merge(...)
+        """
+        if self.buffering:
+            yield self
+            return
+
+        self.buffering = True
+        try:
+            yield self
+        except Exception:
+            self.buffering = False
+            print('Dispatch - {} messages/records discarded'.format(len(self.sqs_buffer) + len(self.kinesis_buffer)))
+            self.sqs_buffer, self.kinesis_buffer = [], []
+            raise
+
+        self.buffering = False
+        failed = self.flush()
+        if failed:
+            keys = [json.loads(item).get('dynamoKey') or item for item in failed]
+            raise DispatchError('{} buffered messages/records not sent: {}'.format(len(failed), keys))
+
+    def flush(self):
+        """
+        Send the buffered Kinesis records and SQS messages, returns the ones still failing.
+
+        Kinesis records are sent before SQS messages, so an activity is registered before the
+        lambda that processes it can report it. Kinesis batches go one after another, the
+        stream throughput is the limit, and the retries of each batch grow with the number of
+        batches, as throttling does.
+        """
+        kinesis_buffer, self.kinesis_buffer = self.kinesis_buffer, []
+        sqs_buffer, self.sqs_buffer = self.sqs_buffer, []
+
+        failed = []
+        batches = make_batches(kinesis_buffer, KINESIS_BATCH_SIZE, KINESIS_BATCH_BYTES, sizeof=record_size)
+        for batch in batches:
+            failed.extend(record['Data'] for record in
+                self.send_batch_kinesis(batch, retries=DISPATCH_RETRIES + len(batches)))
+
+        if sqs_buffer:
+            queues = OrderedDict()
+            for queue_url, body in sqs_buffer:
+                queues.setdefault(queue_url, []).append(body)
+            batches = [(queue_url, batch) for queue_url, bodies in queues.items()
+                       for batch in make_batches(bodies, SQS_BATCH_SIZE, SQS_BATCH_BYTES)]
+            with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+                for messages in executor.map(lambda batch: self.send_batch_sqs(*batch), batches):
+                    failed.extend(messages)
+        return failed
+
 
     ## ----------------------
     # STAC
@@ -261,6 +544,10 @@ class CubeServices:
         time = '{}/{}'.format(activity['start'], activity['end'])
         bucket_archive_name = 'bdc-archive'
 
+        # Scenes that cover less than min_overlap of the tile polygon are dropped
+        tile_geom = activity.get('geom')
+        min_overlap = float(activity.get('min_overlap', STAC_MIN_OVERLAP))
+
         scenes = {}
         for dataset in datasets:
             filter_opts = dict(
@@ -274,7 +561,15 @@ class CubeServices:
                 if f['type'] == 'Feature':
                     id = f['id']
                     date = f['properties']['datetime'] 
-                    
+
+                    overlap = None
+                    if tile_geom and f.get('geometry'):
+                        overlap = get_overlap(f['geometry'], tile_geom)
+                        if overlap <= 0 or overlap < min_overlap:
+                            print('STAC scene {} dropped - overlap {}'.format(id, round(overlap, 4)))
+                            continue
+                        overlap = round(overlap, 4)
+
                     # Get file link and name
                     assets = f['assets']
                     for band in bands:
@@ -289,6 +584,7 @@ class CubeServices:
                         scene['date'] = date
                         scene['band'] = band
                         scene['link'] = band_obj['href']
+                        scene['overlap'] = overlap
                         if dataset == 'MOD13Q1' and band == 'quality':
                             scene['link'] = scene['link'].replace('quality','reliability')
 
@@ -313,6 +609,15 @@ class CubeServices:
             return False
         return True
 
+    def list_keys_S3(self, prefix, bucket_name=BUCKET_NAME):
+        # All keys under prefix, one request per 1000 keys
+        keys = set()
+        paginator = self.S3client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys.add(obj['Key'])
+        return keys
+
     def save_file_S3(self, key, activity):
         return self.S3client.put_object(
             Bucket=BUCKET_NAME,
@@ -0,0 +1,486 @@
+import threading
+import time
+import numpy
+import rasterio
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
+
+from .builder import BufferPool, ordered_map
+from .composite import COMPOSITES, first_clear, median_histogram
+
+
+# Composite functions of the histogram median, the others need the stack of the band in memory
+HISTOGRAM_FUNCTIONS = ('MED', 'STK')
+# Fewest scenes of a histogram median: it reads every scene at least twice and keeps ~260 bytes
+# per pixel (MEDIAN_BUCKETS + 2 uint16 counts), the sort keeps ~5 bytes per pixel and scene
+HISTOGRAM_MIN_SCENES = 128
+
+
+#############################
+def blend_band_stream(scenes, band, window, get_bmask, nodata, dtype, functions):
+    """
+    MED and STK of a band streaming the scenes, see `median_histogram`.
+    Returns {function: composite} and the count of clear observations.
+    """
+    unsupported = set(functions) - set(HISTOGRAM_FUNCTIONS)
+    if unsupported:
+        raise ValueError('Composite functions {} need the median by sort'.format(sorted(unsupported)))
+
+    shape = (int(window.height), int(window.width))
+    stack_raster = numpy.zeros(shape, dtype=dtype)
+    notdonemask = numpy.ones(shape, dtype=numpy.bool_)
+    passes = 0
+
+    def read_scenes():
+        nonlocal stack_raster, notdonemask, passes
+        passes += 1
+
+        # For all pair (quality,band) scenes
+        for order, (ssrcs, _) in enumerate(scenes):
+            raster = ssrcs[band].read(1, window=window)
+            bmask = get_bmask(order)
+            yield raster, bmask
+
+            if passes > 1:
+                continue
+
+            # Evaluate the STACK image, in the first pass over the scenes
+            # Pixels that have been already been filled by previous rasters will be masked in the current raster
+            raster[raster == nodata] = 0
+            todomask = notdonemask * numpy.invert(bmask)
+            notdonemask = notdonemask * bmask
+            stack_raster += (todomask * raster.astype(dtype))
+
+    median_raster, count_raster = median_histogram(read_scenes, shape, nodata)
+    stack_raster[notdonemask] = nodata
+
+    composites = {'MED': median_raster.astype(dtype, copy=False), 'STK': stack_raster}
+    return dict((function, composites[function]) for function in functions), count_raster
+
+
+def blend_window(scenes, bands, window, nodata, dtype, functions=('MED', 'STK'), median='sort',
+                 provenance=False, pool=None):
+    """
+    Composite a window of the scenes of a period for all `bands` and composite `functions`.
+
+    `scenes` is a list of ({band: dataset}, quality dataset) ordered by efficacy/resolution.
+    The quality block of each scene is read once and its clear mask is used by all bands, the
+    stack of each band is read once and used by all functions (see `COMPOSITES`).
+    `median` is 'sort' (stack of the band in memory) or 'histogram' (scenes streamed once per
+    pass, only for MED and STK).
+    With `provenance` the index in `scenes` of the scene of the STK pixel is also given (int16,
+    `nodata` where no scene is clear), it is the same for all bands.
+    The stacks and work arrays are taken from `pool` (BufferPool) and given back, the results
+    are new arrays.
+    Returns {band: {function: composite}}, the count of clear observations of the window and
+    the index of the STK scene (None without `provenance`).
+    """
+    numscenes = len(scenes)
+    shape = (int(window.height), int(window.width))
+
+    # Invalid (fill or cloudy) pixels of each scene, True => nodata.
+    # Histogram median keeps them as bits, 1/8 of a boolean stack
+    if median == 'histogram':
+        packed = [numpy.packbits(msrc.read(1, window=window) != 1, axis=-1) for _, msrc in scenes]
+
+        def get_bmask(order):
+            return numpy.unpackbits(packed[order], axis=-1, count=shape[1]).view(numpy.bool_)
+
+        results = {}
+        count_raster = None
+        for band in bands:
+            results[band], count_raster = blend_band_stream(scenes, band, window, get_bmask,
+                nodata, dtype, functions)
+
+        index_raster = None
+        if provenance:
+            # Scenes in reverse order, so the first clear one is the last written
+            index_raster = numpy.full(shape, nodata, dtype=numpy.int16)
+            for order in reversed(range(numscenes)):
+                index_raster[~get_bmask(order)] = order
+        return results, count_raster, index_raster
+
+    pool = pool if pool is not None else BufferPool(reuse=False)
+    stack_bmask = pool.take((numscenes,) + shape, numpy.bool_)
+    for order, (_, msrc) in enumerate(scenes):
+        mask = msrc.read(1, window=window)
+        numpy.not_equal(mask, 1, out=stack_bmask[order])
+    count_raster = numscenes - numpy.count_nonzero(stack_bmask, axis=0)
+
+    index_raster = None
+    if provenance:
+        index, found = first_clear(stack_bmask)
+        index_raster = index.astype(numpy.int16)
+        index_raster[~found] = nodata
+
+    results = {}
+    for band in bands:
+        # Stack of all images of the band, read in place
+        stack = pool.take((numscenes,) + shape, numpy.int16)
+        for order, (ssrcs, _) in enumerate(scenes):
+            ssrcs[band].read(1, window=window, out=stack[order])
+
+        results[band] = dict((function, COMPOSITES[function](stack, stack_bmask, nodata, dtype, pool))
+                             for function in functions)
+        pool.give(stack)
+
+    pool.give(stack_bmask)
+    return results, count_raster, index_raster
+
+
+#############################
+class PipelineTiming(object):
+    """
+    Seconds spent by `blend_windows` reading and compositing windows, summed over threads.
+    `wait` is the time the composite waited for reads, so `overlap` is the fraction of the
+    read time hidden behind the composite of other windows.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = 0
+        self.read = 0.
+        self.compute = 0.
+        self.wait = 0.
+        self.wall = 0.
+
+    def add(self, **seconds):
+        with self.lock:
+            for name, value in seconds.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def overlap(self):
+        return max(0., 1. - self.wait / self.read) if self.read else 0.
+
+    def report(self):
+        return 'windows: {} read: {:.2f}s compute: {:.2f}s wait: {:.2f}s wall: {:.2f}s overlap: {:.0f}%'.format(
+            self.windows, self.read, self.compute, self.wait, self.wall, 100. * self.overlap)
+
+
+class TimedDataset(object):
+    """Dataset whose reads are added to a PipelineTiming."""
+
+    def __init__(self, dataset, timing):
+        self.dataset = dataset
+        self.timing = timing
+
+    @property
+    def name(self):
+        return self.dataset.name
+
+    def read(self, *args, **kwargs):
+        start = time.time()
+        data = self.dataset.read(*args, **kwargs)
+        self.timing.add(read=time.time() - start)
+        return data
+
+
+class WindowBlock(object):
+    """Block of a dataset read ahead, `read` gives a copy of it as the dataset read of the window."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, indexes, window=None, out=None):
+        if out is None:
+            return self.data.copy()
+        numpy.copyto(out, self.data)
+        return out
+
+
+class ThreadScenes(object):
+    """Handles of the scenes opened by each thread, datasets can not be shared between threads."""
+
+    def __init__(self, scenes, bands):
+        self.names = [(dict((band, ssrcs[band].name) for band in bands), msrc.name) for ssrcs, msrc in scenes]
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self):
+        scenes = getattr(self.local, 'scenes', None)
+        if scenes is None:
+            scenes = self.local.scenes = []
+            with self.lock:
+                self.opened.append(scenes)
+            for band_names, quality_name in self.names:
+                ssrcs = dict((band, rasterio.open(name)) for band, name in band_names.items())
+                scenes.append((ssrcs, rasterio.open(quality_name)))
+        return scenes
+
+    def close(self):
+        for scenes in self.opened:
+            for ssrcs, msrc in scenes:
+                for ssrc in ssrcs.values():
+                    ssrc.close()
+                msrc.close()
+
+
+def read_window(scenes, bands, window):
+    # Blocks of the window of all scenes, as ({band: WindowBlock}, quality WindowBlock)
+    return [(dict((band, WindowBlock(ssrcs[band].read(1, window=window))) for band in bands),
+             WindowBlock(msrc.read(1, window=window))) for ssrcs, msrc in scenes]
+
+
+def split_window(blocks, window, sub_window):
+    # Blocks of sub_window from the blocks of window (see read_window)
+    row_off, col_off = int(sub_window.row_off - window.row_off), int(sub_window.col_off - window.col_off)
+    rows = slice(row_off, row_off + int(sub_window.height))
+    cols = slice(col_off, col_off + int(sub_window.width))
+    return [(dict((band, WindowBlock(block.data[rows, cols])) for band, block in ssrcs.items()),
+             WindowBlock(msrc.data[rows, cols])) for ssrcs, msrc in blocks]
+
+
+def window_itemsize(scenes, bands):
+    # Bytes of one pixel of the window of all scenes and bands, with quality
+    return sum(numpy.dtype(ssrcs[band].dtypes[0]).itemsize for ssrcs, _ in scenes for band in bands) + \
+        sum(numpy.dtype(msrc.dtypes[0]).itemsize for _, msrc in scenes)
+
+
+def plan_reads(windows, max_bytes, itemsize):
+    """
+    Group the block windows (in rows, as `block_windows`) into larger read windows.
+
+    Whole rows of blocks are grouped while the read window of all scenes (`itemsize` bytes
+    per pixel) fits in `max_bytes`. When a single row does not fit, it is split in runs of
+    adjacent blocks that fit (at least one block). Adjacent blocks are near in the GeoTIFF,
+    so each read window takes few and large range requests.
+    Returns a list of (read window, [block windows]).
+    """
+    rows = OrderedDict()
+    for window in windows:
+        rows.setdefault((window.row_off, window.height), []).append(window)
+
+    def union(blocks):
+        col_off = min(block.col_off for block in blocks)
+        row_off = min(block.row_off for block in blocks)
+        width = max(block.col_off + block.width for block in blocks) - col_off
+        height = max(block.row_off + block.height for block in blocks) - row_off
+        return Window(col_off, row_off, width, height)
+
+    def size(window):
+        return int(window.width) * int(window.height) * itemsize
+
+    plan = []
+    group = []
+    for blocks in rows.values():
+        blocks = sorted(blocks, key=lambda block: block.col_off)
+        if size(union(blocks)) > max_bytes:
+            if group:
+                plan.append((union(group), group))
+                group = []
+            run = []
+            for block in blocks:
+                if run and size(union(run + [block])) > max_bytes:
+                    plan.append((union(run), run))
+                    run = []
+                run.append(block)
+            plan.append((union(run), run))
+            continue
+
+        if group and size(union(group + blocks)) > max_bytes:
+            plan.append((union(group), group))
+            group = []
+        group = group + blocks
+    if group:
+        plan.append((union(group), group))
+    return plan
+
+
+def window_bytes(window, itemsize):
+    # Bytes of the blocks of window, `itemsize` bytes per pixel (see window_itemsize)
+    return int(window.height) * int(window.width) * itemsize
+
+
+class ReadBudget(object):
+    """
+    Bytes of the windows read ahead by `prefetch_windows` and not released yet, shared with the
+    threads that composite them, so blocks count until the composite releases them.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, wait=False):
+        """
+        Count size bytes when they fit in the budget (or nothing is counted), with `wait` until
+        other bytes are released. Returns whether they were counted.
+        """
+        with self.condition:
+            while self.used and self.used + size > self.max_bytes:
+                if not wait:
+                    return False
+                self.condition.wait()
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def prefetch_windows(scenes, bands, windows, depth, max_bytes, readers=1, timing=None, budget=None):
+    """
+    Yield (window, blocks of the window, see `read_window`) in the order of `windows`.
+
+    Up to `depth` windows are read ahead by `readers` threads while the caller composites the
+    current one, as long as the blocks fit in `max_bytes`. The blocks of a window are released
+    when the caller asks for the next one, or with `budget` (ReadBudget) when the caller
+    releases them, and the next window waits for them when nothing else is read ahead.
+    """
+    timing = timing if timing is not None else PipelineTiming()
+    windows = list(windows)
+    itemsize = window_itemsize(scenes, bands)
+    owned = budget is None
+    budget = ReadBudget(max_bytes) if owned else budget
+
+    handles = ThreadScenes(scenes, bands) if readers > 1 else None
+
+    def read(window):
+        start = time.time()
+        blocks = read_window(handles.get() if handles else scenes, bands, window)
+        timing.add(read=time.time() - start)
+        return window, blocks
+
+    executor = ThreadPoolExecutor(max_workers=max(readers, 1))
+    pending = deque()
+    index = 0
+    try:
+        while index < len(windows) or pending:
+            # Submit the reads of the next windows within the depth and memory budget
+            while index < len(windows) and len(pending) < max(depth, 1):
+                window = windows[index]
+                size = window_bytes(window, itemsize)
+                if not budget.acquire(size, wait=not pending):
+                    break
+                pending.append((size, executor.submit(read, window)))
+                index += 1
+
+            size, future = pending.popleft()
+            start = time.time()
+            result = future.result()
+            timing.add(wait=time.time() - start)
+            yield result
+            if owned:
+                budget.release(size)
+    finally:
+        executor.shutdown(wait=True)
+        if handles:
+            handles.close()
+
+
+def window_releases(budget, size, count):
+    # Callables that release size bytes of budget when all `count` of them were called
+    lock = threading.Lock()
+    remaining = [count]
+
+    def release():
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            budget.release(size)
+    return [release] * count
+
+
+def blend_windows(scenes, bands, windows, nodata, dtype, functions=('MED', 'STK'), workers=1,
+                  median='sort', prefetch=0, prefetch_bytes=None, readers=1, coalesce_bytes=None,
+                  provenance=False, pool=None, timing=None):
+    """
+    Yield (window, blend_window results) for all windows, in the order of `windows` (of the
+    read plan, when coalesced).
+
+    With `workers` > 1 the windows are composited in a thread pool. The caller consumes the
+    results in order and is the only writer of the outputs.
+    With `coalesce_bytes` the windows are read in larger windows of up to that size (see
+    `plan_reads`) and composited from memory, in the order of the plan.
+    With `prefetch` > 0 the blocks of the next `prefetch` (read) windows are read in background
+    by `readers` threads (see `prefetch_windows`), so reads overlap the composite. The blocks
+    read count in `prefetch_bytes` until their composite ends, in the workers too. Otherwise
+    each window is read by the thread that composites it and datasets can not be shared
+    between threads, so each worker opens its own handles of the scenes.
+    The work arrays of the windows are reused from `pool` (BufferPool, one per call by default).
+    `timing` (PipelineTiming) gets the time spent reading and compositing.
+    """
+    timing = timing if timing is not None else PipelineTiming()
+    pool = pool if pool is not None else BufferPool()
+    handles = None
+    source = None
+    start = time.time()
+    reads = timing.read
+    itemsize = window_itemsize(scenes, bands)
+    # blocks read ahead count in the prefetch budget until their composite ends
+    budget = ReadBudget(prefetch_bytes or float('inf')) if prefetch > 0 else None
+
+    if coalesce_bytes:
+        plan = plan_reads(windows, coalesce_bytes, itemsize)
+        if prefetch > 0:
+            source = prefetch_windows(scenes, bands, [window for window, _ in plan], prefetch,
+                prefetch_bytes or float('inf'), readers, timing, budget)
+        else:
+            def read_plan():
+                for window, _ in plan:
+                    started = time.time()
+                    blocks = read_window(scenes, bands, window)
+                    elapsed = time.time() - started
+                    timing.add(read=elapsed, wait=elapsed)
+                    yield window, blocks
+            source = read_plan()
+        # the read window is released by the composite of its last block
+        def split_plan():
+            for (window, blocks), (_, block_windows) in zip(source, plan):
+                releases = [None] * len(block_windows)
+                if budget is not None:
+                    releases = window_releases(budget, window_bytes(window, itemsize), len(block_windows))
+                for block, release in zip(block_windows, releases):
+                    yield block, split_window(blocks, window, block), release
+        items = split_plan()
+    elif prefetch > 0:
+        source = prefetch_windows(scenes, bands, windows, prefetch, prefetch_bytes or float('inf'),
+            readers, timing, budget)
+        items = ((window, blocks, lambda size=window_bytes(window, itemsize): budget.release(size))
+                 for window, blocks in source)
+    elif workers <= 1:
+        timed = [(dict((band, TimedDataset(ssrcs[band], timing)) for band in bands), TimedDataset(msrc, timing))
+                 for ssrcs, msrc in scenes]
+        items = ((window, timed, None) for window in windows)
+    else:
+        handles = ThreadScenes(scenes, bands)
+        items = ((window, None, None) for window in windows)
+
+    def composite(item):
+        window, window_scenes, release = item
+        try:
+            if window_scenes is None:
+                window_scenes = [(dict((band, TimedDataset(ssrcs[band], timing)) for band in bands),
+                                  TimedDataset(msrc, timing)) for ssrcs, msrc in handles.get()]
+            started = time.time()
+            result = blend_window(window_scenes, bands, window, nodata, dtype, functions, median, provenance, pool)
+            timing.add(compute=time.time() - started, windows=1)
+        finally:
+            if release is not None:
+                release()
+        return window, result
+
+    results = ordered_map(composite, items, workers)
+    try:
+        for result in results:
+            yield result
+    finally:
+        # Wait the running workers before closing their datasets
+        results.close()
+        if source is not None:
+            source.close()
+        if handles:
+            handles.close()
+
+        # Reads of the composite thread are not overlapped with it
+        if source is None:
+            timing.add(compute=reads - timing.read, wait=timing.read - reads)
+        timing.add(wall=time.time() - start)
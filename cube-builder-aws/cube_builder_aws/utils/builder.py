@@ -1,10 +1,21 @@
+import io
+import os
 import numpy
 import datetime
 import rasterio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 from numpngw import write_png
+from rasterio.errors import RasterioIOError
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
 from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 #############################
@@ -154,9 +165,12 @@ def encode_key(activity, keylist):
 
 ############################
 def getMaskStats(mask):
+	# Cloud ratio and efficacy of a cloud mask (0 fill, 1 clear, 2 cloud), the clear
+	# and cloudy pixels are counted in a single pass
 	totpix   = mask.size
-	clearpix = numpy.count_nonzero(mask == 1)
-	cloudpix = numpy.count_nonzero(mask == 2)
+	counts = numpy.bincount(mask.ravel(), minlength=3)
+	clearpix = int(counts[1])
+	cloudpix = int(counts[2])
 	imagearea = clearpix + cloudpix
 
 	cloud_ratio = 100
@@ -168,124 +182,391 @@ def getMaskStats(mask):
 
 
 ############################
-def getMask(raster, dataset):
+# Landsat-8 SR pixel_qa bits
+LC8SR_FILL = 1                  # warped images have 0 as fill area
+LC8SR_RADSAT = 4 + 8            # 0000 0000 0000 1100
+LC8SR_CLOUD = 16 + 32 + 64      # 0000 0000 0110 0000
+LC8SR_SHADOW = 128 + 256        # 0000 0001 1000 0000
+LC8SR_SNOWICE = 512 + 1024      # 0000 0110 0000 0000
+LC8SR_CIRRUS = 2048 + 4096      # 0001 1000 0000 0000
+
+
+def lc8sr_classes():
+    """
+    Lookup table of all pixel_qa codes to 0 - fill, 1 - clear data, 2 - not clear (saturated,
+    cloud, shadow, snow/ice or cirrus with medium or high confidence), before the dilation.
+    """
+    codes = numpy.arange(2 ** 16, dtype=numpy.uint32)
+    notclear = ((codes & LC8SR_RADSAT) > 4) | \
+        ((codes & LC8SR_CLOUD) > 64) | \
+        ((codes & LC8SR_SHADOW) > 256) | \
+        ((codes & LC8SR_SNOWICE) > 512) | \
+        ((codes & LC8SR_CIRRUS) > 4096)
+    return numpy.where(notclear, 2, codes > LC8SR_FILL).astype(numpy.uint8)
+
+
+# Built once per process, 64KB
+LC8SR_CLASSES = lc8sr_classes()
+
+
+def dilate(mask, size):
+    """
+    Binary dilation of `mask` by a `size` x `size` square, the same of
+    `ndi.binary_dilation(mask, structure=numpy.ones((size, size)))`, as a row then a column
+    pass of shifted ORs (the square is separable).
+    """
+    # ndimage centers an even structure after the middle: pixels i - size // 2 .. i + (size - 1) // 2
+    before = (size - 1) // 2
+    for axis in (1, 0):
+        source = mask
+        mask = numpy.zeros_like(source)
+        length = source.shape[axis]
+        for offset in range(-before, size - before):
+            target = [slice(None)] * source.ndim
+            shifted = [slice(None)] * source.ndim
+            target[axis] = slice(max(-offset, 0), length - max(offset, 0))
+            shifted[axis] = slice(max(offset, 0), length - max(-offset, 0))
+            mask[tuple(target)] |= source[tuple(shifted)]
+    return mask
+
+
+def mask_chunks(rows, chunk_rows):
+    # Row ranges (start, end) of the chunks of a mask
+    return [(row, min(row + chunk_rows, rows)) for row in range(0, rows, chunk_rows)]
+
+
+def run_chunks(func, chunks, workers=1):
+    # func(chunk) for all chunks, in a thread pool with workers > 1
+    for _ in ordered_map(func, chunks, workers):
+        pass
+
+
+def dilate_chunks(mask, size, chunks, workers=1):
+    """
+    `dilate` of `mask` by chunks of rows, each one read with a halo of the rows its square
+    reaches, so the result is the same of the whole mask.
+    """
+    before = (size - 1) // 2
+    after = size - 1 - before
+    out = numpy.empty_like(mask)
+
+    def dilate_chunk(chunk):
+        start, end = chunk
+        top = max(start - before, 0)
+        dilated = dilate(mask[top:min(end + after, mask.shape[0])], size)
+        out[start:end] = dilated[start - top:end - top]
+
+    run_chunks(dilate_chunk, chunks, workers)
+    return out
+
+
+def fill_small_holes(mask, area_threshold, connectivity=1, chunks=None, workers=1):
+    """
+    Set in place the holes (False components) of `mask` smaller than `area_threshold` pixels,
+    the same of `remove_small_holes(mask, area_threshold, connectivity, in_place=True)`.
+
+    The holes are labelled by chunks of rows (all rows by default) in a thread pool. Labels
+    of holes that touch across the border of two chunks are joined as one component before
+    the areas are compared, so holes split by the chunks are filled as in the whole mask.
+    """
+    chunks = chunks or [(0, mask.shape[0])]
+    selem = ndi.generate_binary_structure(mask.ndim, connectivity)
+    labels = numpy.empty(mask.shape, dtype=numpy.int32)
+
+    def label_chunk(chunk):
+        start, end = chunk
+        count = ndi.label(~mask[start:end], selem, output=labels[start:end])
+        return numpy.bincount(labels[start:end].ravel(), minlength=count + 1)
+
+    # Areas of the holes by global label, the labels of chunk k follow offsets[k]
+    counts = list(ordered_map(label_chunk, chunks, workers))
+    offsets = numpy.cumsum([0] + [len(count) - 1 for count in counts])
+    areas = numpy.concatenate([[0]] + [count[1:] for count in counts])
+
+    # Holes joined across the borders: neighbour pixels (also diagonal with connectivity 2)
+    # of the last and first rows of two chunks
+    upper, lower = [], []
+    width = mask.shape[1]
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    for index, ((_, end), (start, _)) in enumerate(zip(chunks[:-1], chunks[1:])):
+        for shift in shifts:
+            above = labels[end - 1, max(-shift, 0):width - max(shift, 0)]
+            below = labels[start, max(shift, 0):width - max(-shift, 0)]
+            joined = (above > 0) & (below > 0)
+            upper.append(above[joined] + offsets[index])
+            lower.append(below[joined] + offsets[index + 1])
+
+    if sum(len(pairs) for pairs in upper):
+        upper, lower = numpy.concatenate(upper), numpy.concatenate(lower)
+        graph = coo_matrix((numpy.ones(len(upper), dtype=numpy.int8), (upper, lower)),
+                           shape=(len(areas), len(areas)))
+        _, component = connected_components(graph, directed=False)
+        areas = numpy.bincount(component, weights=areas)[component]
+
+    small = areas < area_threshold
+    small[0] = False
+    if not small.any():
+        return mask
+
+    def fill_chunk(item):
+        index, (start, end) = item
+        lookup = small[offsets[index]:offsets[index + 1] + 1].copy()
+        lookup[0] = False
+        if lookup.any():
+            mask[start:end] |= lookup[labels[start:end]]
+
+    run_chunks(fill_chunk, list(enumerate(chunks)), workers)
+    return mask
+
+
+def lc8sr_mask(raster, workers=1, chunk_rows=None):
+    """
+    Cloud mask (0 fill, 1 clear, 2 cloud) of a Landsat-8 SR pixel_qa image.
+    Codes are classified by LC8SR_CLASSES, not clear pixels are dilated by a 6x6 square and
+    their holes smaller than 80 pixels are filled.
+    The image is processed by chunks of `chunk_rows` (one per worker by default) in a thread
+    pool of `workers`, the mask is the same of the whole image.
+    """
+    rows = raster.shape[0]
+    chunks = mask_chunks(rows, chunk_rows or -(-rows // max(workers, 1)))
+    notcleararea = numpy.empty(raster.shape, dtype=numpy.bool_)
+    rastercm = numpy.empty(raster.shape, dtype=numpy.uint16)
+
+    def classify_chunk(chunk):
+        start, end = chunk
+        classes = LC8SR_CLASSES[raster[start:end].astype(numpy.uint16, copy=False)]
+        numpy.equal(classes, 2, out=notcleararea[start:end])
+        # Clear area is the area with valid data and with no Cloud or Snow, set below
+        numpy.not_equal(classes, 0, out=rastercm[start:end])
+
+    run_chunks(classify_chunk, chunks, workers)
+    notcleararea = dilate_chunks(notcleararea, 6, chunks, workers)
+    fill_small_holes(notcleararea, area_threshold=80, connectivity=1, chunks=chunks, workers=workers)
+
+    def code_chunk(chunk):
+        start, end = chunk
+        numpy.copyto(rastercm[start:end], 2, where=notcleararea[start:end])
+
+    run_chunks(code_chunk, chunks, workers)
+    return rastercm
+
+
+############################
+# QA decoders of the datasets, by name, see register_dataset
+QA_DECODERS = OrderedDict()
+
+
+class QADecoder(object):
+    """
+    QA encoding of a dataset: its native resolution (meters), the nodata of its scenes that do
+    not set one in their profile and the cloud mask (0 fill, 1 clear, 2 cloud) of its quality
+    band, by a lookup table of the codes (plus `offset`) or by a
+    `kernel(raster, workers, chunk_rows)`.
+    """
+
+    def __init__(self, name, resolution=None, lut=None, offset=0, kernel=None,
+                 quality_nodata=0, band_nodata=False, aliases=(), contains=False):
+        self.name = name
+        self.names = (name,) + tuple(aliases)
+        self.contains = contains
+        self.resolution = resolution
+        self.lut = None if lut is None else numpy.asarray(lut, dtype=numpy.uint16)
+        self.offset = offset
+        self.kernel = kernel
+        self.quality_nodata = quality_nodata
+        self.band_nodata = band_nodata
+
+    def matches(self, dataset):
+        if self.contains:
+            return any(name in dataset for name in self.names)
+        return dataset in self.names
+
+    @property
+    def has_mask(self):
+        return self.kernel is not None or self.lut is not None
+
+    def mask(self, raster, workers=1, chunk_rows=None):
+        if self.kernel is not None:
+            return self.kernel(raster, workers, chunk_rows)
+        if self.offset:
+            raster = raster + self.offset
+        return numpy.take(self.lut, raster)
+
+    def source_nodata(self, band, nodata):
+        # nodata of a scene band without nodata in its profile
+        if band == 'quality':
+            return self.quality_nodata
+        return nodata if self.band_nodata else 0
+
+
+def register_dataset(name, **kwargs):
+    """Register the QADecoder of dataset `name`, datasets match the first decoder registered."""
+    QA_DECODERS[name] = QADecoder(name, **kwargs)
+    get_qa_decoder.cache_clear()
+    return QA_DECODERS[name]
+
+
+@lru_cache(maxsize=None)
+def get_qa_decoder(dataset):
+    """QADecoder of `dataset` (None if unknown), matched once per process."""
+    for decoder in QA_DECODERS.values():
+        if decoder.matches(dataset):
+            return decoder
+    return None
+
+
+# Landsat-8 SR pixel_qa codes, see LC8SR_CLASSES
+register_dataset('LC8SR', contains=True, resolution=30, kernel=lc8sr_mask,
+                 quality_nodata=LC8SR_FILL, band_nodata=True)
+
+# CBERS-4 quality
+# Key Summary        QA Description
+#   0 Fill/No Data - Not Processed
+# 127 Good Data    - Use with confidence
+# 255 Cloudy       - Target not visible, covered with cloud
+CB4_LUT = numpy.zeros(256, dtype=numpy.uint16)
+CB4_LUT[127] = 1
+CB4_LUT[255] = 2
+register_dataset('CBERS-4_AWFI', resolution=64, lut=CB4_LUT, band_nodata=True)
+register_dataset('CBERS-4_MUX', resolution=20, lut=CB4_LUT, band_nodata=True)
+# CB4 scenes share the quality codes, but keep 0 as nodata of the bands without one
+register_dataset('CB4_AWFI', aliases=('CB4_MUX',), lut=CB4_LUT)
+# other CBERS collections only share the nodata convention
+register_dataset('CBERS', contains=True, band_nodata=True)
+
+# S2 sen2cor - The generated classification map is specified as follows:
+# Label Classification
+#  0		NO_DATA
+#  1		SATURATED_OR_DEFECTIVE
+#  2		DARK_AREA_PIXELS
+#  3		CLOUD_SHADOWS
+#  4		VEGETATION
+#  5		NOT_VEGETATED
+#  6		WATER
+#  7		UNCLASSIFIED
+#  8		CLOUD_MEDIUM_PROBABILITY
+#  9		CLOUD_HIGH_PROBABILITY
+# 10		THIN_CIRRUS
+# 11		SNOW
+#                 0 1 2 3 4 5 6 7 8 9 10 11
+register_dataset('S2SR', contains=True, resolution=10, lut=[0, 0, 2, 2, 1, 1, 1, 2, 2, 2, 1, 1])
+
+# MOD13Q1 Pixel Reliability
+# Note that 1 was added to this image in downloadModis because of warping
+# Rank/Key Summary QA 		Description
+# -1 		Fill/No Data 	Not Processed
+# 0 		Good Data 		Use with confidence
+# 1 		Marginal data 	Useful, but look at other QA information
+# 2 		Snow/Ice 		Target covered with snow/ice
+# 3 		Cloudy 			Target not visible, covered with cloud
+# warped images have 0 as fill area
+register_dataset('MOD13Q1', aliases=('MYD13Q1',), resolution=231, lut=[0, 1, 1, 2, 2], offset=1)
+
+
+############################
+def getMask(raster, dataset, workers=1, chunk_rows=None):
     # Output Cloud Mask codes
     # 0 - fill
     # 1 - clear data
-    # 0 - cloud
-	if 'LC8SR' in dataset:
-		# Input pixel_qa codes
-		fill = 1 				# warped images have 0 as fill area
-		terrain = 2					# 0000 0000 0000 0010
-		radsat = 4+8				# 0000 0000 0000 1100
-		cloud = 16+32+64			# 0000 0000 0110 0000
-		shadow = 128+256			# 0000 0001 1000 0000
-		snowice = 512+1024			# 0000 0110 0000 0000
-		cirrus = 2048+4096			# 0001 1000 0000 0000
-
-		# Start with a zeroed image imagearea
-		imagearea = numpy.zeros(raster.shape, dtype=numpy.bool_)
-		# Mark with True the pixels that contain valid data
-		imagearea = imagearea + raster > fill
-		# Create a notcleararea mask with True where the quality criteria is as follows
-		notcleararea = (raster & radsat > 4) + \
-            (raster & cloud > 64) + \
-            (raster & shadow > 256) + \
-            (raster & snowice > 512) + \
-            (raster & cirrus > 4096)
-
-		strel = numpy.ones((6, 6), dtype=numpy.uint16)
-		out = numpy.empty(notcleararea.shape, dtype=numpy.bool)
-		ndi.binary_dilation(notcleararea, structure=strel, output=out)
-		notcleararea = out
-
-		remove_small_holes(notcleararea, area_threshold=80, connectivity=1, in_place=True)
-
-		# Clear area is the area with valid data and with no Cloud or Snow
-		cleararea = imagearea * numpy.invert(notcleararea)
-		# Code the output image rastercm as the output codes
-		rastercm = (2*notcleararea + cleararea).astype(numpy.uint16)  # .astype(numpy.uint8)
-
-	elif dataset == 'MOD13Q1' or dataset == 'MYD13Q1':
-		# MOD13Q1 Pixel Reliability !!!!!!!!!!!!!!!!!!!!
-        # Note that 1 was added to this image in downloadModis because of warping
-        # Rank/Key Summary QA 		Description
-        # -1 		Fill/No Data 	Not Processed
-        # 0 		Good Data 		Use with confidence
-        # 1 		Marginal data 	Useful, but look at other QA information
-        # 2 		Snow/Ice 		Target covered with snow/ice
-        # 3 		Cloudy 			Target not visible, covered with cloud
-		fill = 0 	# warped images have 0 as fill area
-		lut = numpy.array([0, 1, 1, 2, 2], dtype=numpy.uint8)
-		rastercm = numpy.take(lut, raster+1).astype(numpy.uint8)
-
-	elif 'S2SR' in dataset:
-		# S2 sen2cor - The generated classification map is specified as follows:
-        # Label Classification
-        #  0		NO_DATA
-        #  1		SATURATED_OR_DEFECTIVE
-        #  2		DARK_AREA_PIXELS
-        #  3		CLOUD_SHADOWS
-        #  4		VEGETATION
-        #  5		NOT_VEGETATED
-        #  6		WATER
-        #  7		UNCLASSIFIED
-        #  8		CLOUD_MEDIUM_PROBABILITY
-        #  9		CLOUD_HIGH_PROBABILITY
-        # 10		THIN_CIRRUS
-        # 11		SNOW
-        # 0 1 2 3 4 5 6 7 8 9 10 11
-		lut = numpy.array([0,0,2,2,1,1,1,2,2,2,1, 1],dtype=numpy.uint8)
-		rastercm = numpy.take(lut,raster).astype(numpy.uint8)
-
-	elif dataset == 'CB4_AWFI' or dataset == 'CB4_MUX':
-		# Key Summary        QA Description
-        #   0 Fill/No Data - Not Processed
-        # 127 Good Data    - Use with confidence
-        # 255 Cloudy       - Target not visible, covered with cloud
-        # fill = 0  # warped images have 0 as fill area
-		lut = numpy.zeros(256, dtype=numpy.uint8)
-		lut[127] = 1
-		lut[255] = 2
-		rastercm = numpy.take(lut, raster).astype(numpy.uint8)
-
-	totpix   = rastercm.size
-	clearpix = numpy.count_nonzero(rastercm==1)
-	cloudpix = numpy.count_nonzero(rastercm==2)
-	imagearea = clearpix+cloudpix
-	cloudratio = 100
-	if imagearea != 0:
-		cloudratio = round(100.*cloudpix/imagearea,1)
-	efficacy = round(100.*clearpix/totpix,2)
+    # 2 - cloud
+	decoder = get_qa_decoder(dataset)
+	if decoder is None or not decoder.has_mask:
+		raise ValueError('No cloud mask for dataset {}'.format(dataset))
 
-	return rastercm.astype(numpy.uint16), efficacy, cloudratio
+	rastercm = decoder.mask(raster, workers, chunk_rows)
+	cloudratio, efficacy = getMaskStats(rastercm)
+	return rastercm.astype(numpy.uint16, copy=False), efficacy, cloudratio
 
 
 ############################
-def generateQLook(generalSceneId, qlfiles):
-    profile = None
-    with rasterio.open(qlfiles[0]) as src:
-        profile = src.profile
+# Lines of the quicklooks, the columns follow the aspect of the image
+QLOOK_LINES = 768
+
+
+@lru_cache(maxsize=None)
+def quicklook_lut(dtype):
+    """
+    Lookup table of all values of an 8 or 16 bits integer `dtype`, indexed by their unsigned
+    view, to the 0-255 values of a quicklook: reflectance scaled by 255/10000 and clipped to
+    255, 0 as nodata (values <= 0). Built once per dtype.
+    """
+    dtype = numpy.dtype(dtype)
+    codes = numpy.arange(2 ** (8 * dtype.itemsize), dtype=numpy.uint32)
+    values = codes.astype('u{}'.format(dtype.itemsize)).view(dtype)
+    return quicklook_rescale(values)
+
+
+def quicklook_rescale(raster):
+    # Rescale to 0-255 values, with float32 as the lookup tables are built
+    nodata = raster <= 0
+    scaled = raster.astype(numpy.float32)/10000.*255.
+    scaled[scaled>255] = 255
+    scaled[nodata] = 0
+    return scaled.astype(numpy.uint8)
+
+
+def quicklook_band(raster):
+    # 0-255 quicklook values of a band, by quicklook_lut for 8 and 16 bits integers
+    if raster.dtype.itemsize <= 2 and raster.dtype.kind in 'iu':
+        lut = quicklook_lut(raster.dtype)
+        return numpy.take(lut, raster.view('u{}'.format(raster.dtype.itemsize)))
+    return quicklook_rescale(raster)
+
 
-    numlin = 768
-    numcol = int(float(profile['width'])/float(profile['height'])*numlin)
-    image = numpy.ones((numlin,numcol,len(qlfiles),), dtype=numpy.uint8)
-    pngname = '/tmp/{}.png'.format(generalSceneId)
+def read_quicklook(src, numlin=QLOOK_LINES):
+    # Quicklook band of an open image decimated to numlin lines, GDAL reads it from the nearest overview
+    numcol = int(float(src.width)/float(src.height)*numlin)
+    return quicklook_band(src.read(1, out_shape=(numlin, numcol)))
 
-    nb = 0
+
+def quicklook_path(path):
+    # Quicklook sidecar of an image, see quicklook_sidecar
+    return '{}_ql.tif'.format(os.path.splitext(path)[0])
+
+
+def quicklook_sidecar(file, numlin=QLOOK_LINES):
+    """
+    Quicklook band of the image `file` (usually the name of a MemoryFile just written), as an
+    in memory uint8 GeoTIFF to upload to its `quicklook_path`, so generateQLook does not read
+    the image again.
+    """
+    with rasterio.open(file) as src:
+        band = read_quicklook(src, numlin)
+        crs = src.crs
+        transform = src.transform * Affine.scale(float(src.width) / band.shape[1], float(src.height) / band.shape[0])
+
+    memfile = MemoryFile()
+    with memfile.open(driver='GTiff', width=band.shape[1], height=band.shape[0], count=1, dtype='uint8',
+                      crs=crs, transform=transform, compress='LZW') as dataset:
+        dataset.write(band, 1)
+    return memfile
+
+
+def generateQLook(qlfiles, numlin=QLOOK_LINES, sidecars=False):
+    """
+    PNG quicklook of the bands `qlfiles` (r, g, b), as an in memory file ready to upload.
+    Bands come from their quicklook sidecars with `sidecars` (images without one are read) or
+    from their nearest overview, rescaled by `quicklook_lut`.
+    """
+    bands = []
     for file in qlfiles:
-        with rasterio.open(file) as src:
-            raster = src.read(1, out_shape=(numlin, numcol))
-            # Rescale to 0-255 values
-            nodata = raster <= 0
-            if raster.min() != 0 or raster.max() != 0:
-                raster = raster.astype(numpy.float32)/10000.*255.
-                raster[raster>255] = 255
-            image[:,:,nb] = raster.astype(numpy.uint8) * numpy.invert(nodata)
-            nb += 1
-
-    write_png(pngname, image, transparent=(0, 0, 0))
-    return pngname
+        band = None
+        if sidecars:
+            try:
+                with rasterio.open(quicklook_path(file)) as src:
+                    band = src.read(1)
+            except RasterioIOError:
+                pass
+        if band is None:
+            with rasterio.open(file) as src:
+                band = read_quicklook(src, numlin)
+        bands.append(band)
+    image = numpy.dstack(bands)
+
+    pngfile = io.BytesIO()
+    write_png(pngfile, image, transparent=(0, 0, 0))
+    pngfile.seek(0)
+    return pngfile
 
 ############################
 def remove_small_holes(ar, area_threshold=64, connectivity=1, in_place=False):
@@ -349,6 +630,151 @@ def remove_small_objects(ar, min_size=64, connectivity=1, in_place=False):
     return out
 
 
+#############################
+def ring_area(ring):
+    # Signed area (shoelace), positive for counterclockwise rings
+    area = 0.
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        area += x1 * y2 - x2 * y1
+    return area / 2.
+
+
+def open_ring(ring):
+    ring = [tuple(point[:2]) for point in ring]
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring = ring[:-1]
+    return ring
+
+
+def clip_ring(ring, clip):
+    """
+    Clip a ring by the convex ring `clip` (Sutherland-Hodgman).
+    The area of the result is the area of the intersection, even for concave rings.
+    """
+    orientation = 1. if ring_area(clip) > 0 else -1.
+
+    def inside(p, a, b):
+        return orientation * ((b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])) >= 0
+
+    def intersection(p, q, a, b):
+        dx, dy = q[0] - p[0], q[1] - p[1]
+        ex, ey = b[0] - a[0], b[1] - a[1]
+        t = (ex * (p[1] - a[1]) - ey * (p[0] - a[0])) / (ey * dx - ex * dy)
+        return (p[0] + t * dx, p[1] + t * dy)
+
+    output = ring
+    for a, b in zip(clip, clip[1:] + clip[:1]):
+        if not output:
+            break
+        points, output = output, []
+        s = points[-1]
+        for e in points:
+            if inside(e, a, b):
+                if not inside(s, a, b):
+                    output.append(intersection(s, e, a, b))
+                output.append(e)
+            elif inside(s, a, b):
+                output.append(intersection(s, e, a, b))
+            s = e
+    return output
+
+
+def get_overlap(geometry, tile_geometry):
+    """
+    Fraction (0-1) of the tile polygon covered by a GeoJSON Polygon/MultiPolygon.
+    Both geometries must be in the same CRS (WGS84 for STAC items and Tile.geom_wgs84).
+    """
+    tile_polygon = tile_geometry['coordinates']
+    if tile_geometry['type'] == 'MultiPolygon':
+        tile_polygon = tile_polygon[0]
+    tile_ring = open_ring(tile_polygon[0])
+    tile_area = abs(ring_area(tile_ring))
+    if tile_area == 0:
+        return 0.
+
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+    elif geometry['type'] != 'MultiPolygon':
+        return 0.
+
+    area = 0.
+    for polygon in polygons:
+        for i, ring in enumerate(polygon):
+            # first ring is the exterior, the others are holes
+            clipped = abs(ring_area(clip_ring(open_ring(ring), tile_ring)))
+            area += clipped if i == 0 else -clipped
+    return min(max(area / tile_area, 0.), 1.)
+
+
+def get_date_overlap(overlaps):
+    # Tile fraction covered by the scenes of a date (scenes of a date barely overlap each other)
+    overlaps = [o for o in overlaps or [] if o is not None]
+    if not overlaps:
+        return None
+    return round(min(sum(overlaps), 1.), 4)
+
+
+#############################
+def ordered_map(func, items, workers=1):
+    """
+    Yield func(item) for all items, in the order of items.
+
+    With workers > 1 the calls run in a thread pool, keeping at most `workers`
+    results ahead of the consumer so memory stays bounded.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class BufferPool(object):
+    """
+    Work arrays of the merge and blend loops, reused between scenes and windows.
+
+    `take` gives a free array of the shape and dtype (allocated only when there is none) with
+    undefined values and `give` returns arrays to the pool, so the peak of arrays in use is
+    allocated once per invocation instead of once per scene or window. Arrays handed out of
+    the loops must not come from the pool. It is shared by the worker threads.
+    With `reuse` False arrays are never kept, as without pool (for benchmarks).
+    """
+
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self.lock = threading.Lock()
+        self.free = {}
+        self.takes = 0
+        self.allocations = 0
+
+    def take(self, shape, dtype):
+        key = (tuple(shape), numpy.dtype(dtype).str)
+        with self.lock:
+            self.takes += 1
+            free = self.free.get(key)
+            if free:
+                return free.pop()
+            self.allocations += 1
+        return numpy.empty(shape, dtype=dtype)
+
+    def give(self, *arrays):
+        if not self.reuse:
+            return
+        with self.lock:
+            for array in arrays:
+                if array is not None:
+                    self.free.setdefault((array.shape, array.dtype.str), []).append(array)
+
+
 #############################
 def get_cube_id(cube, function=None):
 	if not function or function.upper() == 'IDENTITY':
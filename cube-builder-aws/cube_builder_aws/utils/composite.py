@@ -0,0 +1,242 @@
+from collections import OrderedDict
+
+import numpy
+
+
+# Value given to invalid pixels of the stack, it is sorted after all valid values
+MEDIAN_SENTINEL = numpy.iinfo(numpy.int16).max
+
+
+#############################
+def median_int16(stack, bmask, nodata, out=None, pool=None):
+    """
+    Median along the time axis (axis 0) of an int16 stack, ignoring pixels where `bmask` is True.
+
+    Gives the same values of `numpy.ma.median(stack masked by bmask, axis=0)` cast to int16:
+    for an odd number of valid pixels the middle one, for an even number the mean of the two
+    middle ones truncated toward zero. Pixels without any valid observation get `nodata`.
+    The invalid pixels are replaced by a sentinel placed after all valid values in the sort,
+    so no masked array is built. The sorted copy of the stack is taken from `pool` (BufferPool).
+    Returns the median and the number of valid observations per pixel.
+    """
+    take = pool.take if pool is not None else numpy.empty
+    data = take(stack.shape, numpy.int16)
+    numpy.copyto(data, stack, casting='unsafe')
+    numpy.copyto(data, MEDIAN_SENTINEL, where=bmask)
+    data.sort(axis=0)
+
+    count = bmask.shape[0] - numpy.count_nonzero(bmask, axis=0)
+    high = count // 2
+    low = numpy.where(count % 2 == 1, high, numpy.maximum(high - 1, 0))
+
+    total = numpy.take_along_axis(data, low[numpy.newaxis], axis=0)[0].astype(numpy.int32)
+    total += numpy.take_along_axis(data, high[numpy.newaxis], axis=0)[0]
+    if pool is not None:
+        pool.give(data)
+    # (low + high) / 2 truncated toward zero
+    total += total < 0
+    total //= 2
+
+    if out is None:
+        out = numpy.empty(total.shape, dtype=numpy.int16)
+    out[...] = total
+    out[count == 0] = nodata
+    return out, count
+
+
+# Buckets of each pass of the histogram median and the range of the first pass (reflectance)
+MEDIAN_BUCKETS = 128
+MEDIAN_RANGE = (0, 10000)
+
+
+def median_histogram(read_scenes, shape, nodata, buckets=MEDIAN_BUCKETS, value_range=MEDIAN_RANGE):
+    """
+    Median of a stream of scenes, with the same result of `median_int16`.
+
+    `read_scenes()` must return an iterable of (raster, bmask) of all scenes, it is called once
+    per pass and the scenes are never stacked. Each pass counts the valid values of every pixel
+    in `buckets` buckets of its current interval, plus one bucket below and one above it, and
+    narrows the interval to the bucket of the lower median rank. The first interval is
+    `value_range`, so for reflectances 10001 values / 128 buckets gives the exact value in two
+    passes; values out of the range take a few more passes over the int16 range.
+    The upper median value (even counts) comes from the counts of the last pass and the
+    minimum value above the interval. Memory per pixel depends only on `buckets` (counts are
+    uint16, so up to 65535 scenes).
+    Returns the median and the number of valid observations per pixel.
+    """
+    int16 = numpy.iinfo(numpy.int16)
+    npixels = shape[0] * shape[1]
+    pixels = numpy.arange(npixels, dtype=numpy.int64).reshape(shape)
+
+    lo = numpy.full(shape, value_range[0], dtype=numpy.int32)
+    hi = numpy.full(shape, value_range[1], dtype=numpy.int32)
+    low_value = numpy.zeros(shape, dtype=numpy.int32)
+    high_value = numpy.zeros(shape, dtype=numpy.int32)
+    count = None
+    pending = None
+    hist = None
+
+    while pending is None or pending.any():
+        width = (hi - lo) // buckets + 1
+        above = numpy.full(shape, int16.max + 1, dtype=numpy.int32)
+        if hist is None:
+            hist = numpy.zeros((buckets + 2,) + shape, dtype=numpy.uint16)
+        else:
+            hist.fill(0)
+        flat = hist.reshape(-1)
+
+        for raster, bmask in read_scenes():
+            value = raster.astype(numpy.int32)
+            valid = ~bmask if pending is None else pending & ~bmask
+
+            bucket = value - lo
+            bucket //= width
+            bucket += 1
+            numpy.clip(bucket, 0, buckets + 1, out=bucket)
+            over = value > hi
+            bucket[over] = buckets + 1
+
+            index = bucket * npixels + pixels
+            flat[index[valid]] += 1
+            numpy.minimum(above, numpy.where(over & valid, value, above), out=above)
+
+        if count is None:
+            count = hist.sum(axis=0, dtype=numpy.int32)
+            pending = count > 0
+            k_low = ((count - 1) // 2).astype(hist.dtype)
+            k_high = (count // 2).astype(hist.dtype)
+
+        # Cumulative counts, the lower median is in the first bucket with more than k_low values
+        numpy.cumsum(hist, axis=0, out=hist)
+        b_low = numpy.argmax(hist > k_low, axis=0)
+        cum_low = numpy.take_along_axis(hist, b_low[numpy.newaxis], axis=0)[0]
+        b_next = numpy.argmax(hist > cum_low, axis=0)
+
+        new_lo = numpy.where(b_low == 0, int16.min,
+            numpy.where(b_low == buckets + 1, hi + 1, lo + (b_low - 1) * width))
+        new_hi = numpy.where(b_low == 0, lo - 1,
+            numpy.where(b_low == buckets + 1, int16.max, numpy.minimum(new_lo + width - 1, hi)))
+
+        # Pixels whose lower median bucket holds a single value are done
+        done = pending & (new_lo == new_hi)
+        low_value[done] = new_lo[done]
+        # The upper median is the same value, the value of the next bucket or the minimum above hi
+        next_value = numpy.where(b_next == buckets + 1, above, lo + (b_next - 1) * width)
+        high_value[done] = numpy.where(cum_low > k_high, new_lo, next_value)[done]
+
+        pending &= ~done
+        lo = numpy.where(pending, new_lo, lo)
+        hi = numpy.where(pending, new_hi, hi)
+
+    # (low + high) / 2 truncated toward zero
+    total = low_value + high_value
+    total += total < 0
+    total //= 2
+
+    median = total.astype(numpy.int16)
+    median[count == 0] = nodata
+    return median, count
+
+
+def first_clear(bmask):
+    """
+    Index of the first clear pixel (False in `bmask`) along the time axis, the scene of the
+    best pixel in the order of the stack, and whether the pixel has any clear observation.
+
+    Same as `argmax(~bmask, axis=0)`, but numpy reduces axis 0 through a transposed copy of
+    the stack. The scenes are scanned in order only for the pixels not found yet, which are
+    few after the first scenes, and pixels without any clear observation are left out first.
+    """
+    flat = bmask.reshape(bmask.shape[0], -1)
+    found = ~numpy.all(bmask, axis=0)
+    index = numpy.zeros(flat.shape[1], dtype=numpy.intp)
+
+    pending = numpy.flatnonzero(flat[0] & found.reshape(-1))
+    for order in range(1, flat.shape[0]):
+        if pending.size == 0:
+            break
+        masked = flat[order, pending]
+        index[pending[~masked]] = order
+        pending = pending[masked]
+    return index.reshape(bmask.shape[1:]), found
+
+
+#############################
+# Composite functions of the blend, by the id of the cube function (cube `<datacube>_<id>`).
+# Each one gets the stack of a band in a window, ordered by efficacy/resolution, and the stack
+# of invalid pixels (True => nodata), and returns the composite of the window.
+# Stack-sized work arrays are taken from `pool` (BufferPool, None allocates them).
+COMPOSITES = OrderedDict()
+# Description of the composite function schema of each registered function
+DESCRIPTIONS = OrderedDict()
+
+# Functions of the cubes created when no list is given (IDENTITY is the warped cube)
+DEFAULT_FUNCTIONS = ['IDENTITY', 'STK', 'MED']
+
+
+def composite(name, description):
+    """Register a blend composite function as `name`."""
+    def register(func):
+        COMPOSITES[name] = func
+        DESCRIPTIONS[name] = description
+        return func
+    return register
+
+
+def get_functions(functions):
+    """Composite functions of `functions` (cube function ids), in the order of the registry."""
+    functions = [function.upper() for function in functions]
+    return [name for name in COMPOSITES if name in functions]
+
+
+def masked_reduce(stack, bmask, fill, reduce, pool=None, **kwargs):
+    # reduce along the time axis of a copy of the stack with invalid pixels set to fill
+    take = pool.take if pool is not None else numpy.empty
+    data = take(stack.shape, stack.dtype)
+    numpy.copyto(data, stack)
+    numpy.copyto(data, fill, where=bmask)
+    result = reduce(data, axis=0, **kwargs)
+    if pool is not None:
+        pool.give(data)
+    return result
+
+
+@composite('STK', 'Stack')
+def stack_composite(stack, bmask, nodata, dtype, pool=None):
+    # Best pixel, the first clear pixel in the order of the stack gathered at once.
+    # A clear pixel with nodata in the band gives 0
+    index, found = first_clear(bmask)
+    raster = numpy.take_along_axis(stack, index[numpy.newaxis], axis=0)[0]
+    stack_raster = numpy.where(raster == nodata, 0, raster).astype(dtype, copy=False)
+    stack_raster[~found] = nodata
+    return stack_raster
+
+
+@composite('MED', 'Median')
+def median_composite(stack, bmask, nodata, dtype, pool=None):
+    return median_int16(stack, bmask, nodata, pool=pool)[0].astype(dtype, copy=False)
+
+
+@composite('AVG', 'Average')
+def mean_composite(stack, bmask, nodata, dtype, pool=None):
+    # Mean of the clear pixels truncated toward zero, like the median
+    count = bmask.shape[0] - numpy.count_nonzero(bmask, axis=0)
+    total = masked_reduce(stack, bmask, 0, numpy.sum, pool, dtype=numpy.int64)
+    mean = numpy.full(count.shape, nodata, dtype=dtype)
+    valid = count > 0
+    mean[valid] = numpy.trunc(total[valid] / count[valid])
+    return mean
+
+
+@composite('MIN', 'Minimum')
+def min_composite(stack, bmask, nodata, dtype, pool=None):
+    minimum = masked_reduce(stack, bmask, numpy.iinfo(numpy.int16).max, numpy.min, pool).astype(dtype)
+    minimum[numpy.all(bmask, axis=0)] = nodata
+    return minimum
+
+
+@composite('MAX', 'Maximum')
+def max_composite(stack, bmask, nodata, dtype, pool=None):
+    maximum = masked_reduce(stack, bmask, numpy.iinfo(numpy.int16).min, numpy.max, pool).astype(dtype)
+    maximum[numpy.all(bmask, axis=0)] = nodata
+    return maximum
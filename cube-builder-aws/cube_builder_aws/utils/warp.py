@@ -0,0 +1,323 @@
+import math
+import numpy
+import rasterio
+
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds, transform as window_transform
+
+from .builder import BufferPool, get_qa_decoder, ordered_map
+
+
+#############################
+def get_source_nodata(src, dataset, band, nodata):
+    # Nodata of the input scene, some ARD collections do not set it in the profile
+    source_nodata = 0
+
+    if src.profile['nodata'] is not None:
+        source_nodata = src.profile['nodata']
+    else:
+        decoder = get_qa_decoder(dataset)
+        if decoder is not None:
+            source_nodata = decoder.source_nodata(band, nodata)
+
+    return source_nodata
+
+
+#############################
+def get_merge_template(src, crs, transform, numcol, numlin, source_nodata, band, nodata):
+    # Profile of the merged image, built from the first scene of the date
+    template = None
+    kwargs = src.meta.copy()
+    kwargs.update({
+        'crs': crs,
+        'transform': transform,
+        'width': numcol,
+        'height': numlin,
+        'nodata': source_nodata
+    })
+
+    with MemoryFile() as memfile:
+        with memfile.open(**kwargs) as dst:
+            template = dst.profile
+
+    if band != 'quality':
+        template['dtype'] = 'int16'
+        template['nodata'] = nodata
+    return template
+
+
+def get_merge_template_from_links(links, dataset, band, crs, transform, numcol, numlin, nodata):
+    with rasterio.Env(CPL_CURL_VERBOSE=False):
+        with rasterio.open(links[0]) as src:
+            source_nodata = get_source_nodata(src, dataset, band, nodata)
+            return get_merge_template(src, crs, transform, numcol, numlin,
+                source_nodata, band, nodata)
+
+
+#############################
+def merge_scene(raster, raster_merge, raster_mask, band, nodata, pool=None):
+    # Put the valid pixels of a warped scene over the merged image (last valid pixel wins).
+    # For quality band, only pixels not filled by a previous scene are summed.
+    # Work arrays are taken from the pool, if any
+    take = pool.take if pool is not None else numpy.empty
+    valid = numpy.not_equal(raster, nodata, out=take(raster.shape, numpy.bool_))
+    if band != 'quality':
+        numpy.copyto(raster_merge, raster, where=valid)
+    else:
+        filled = numpy.multiply(raster, raster_mask, out=take(raster.shape, raster_merge.dtype))
+        raster_merge += filled
+        numpy.copyto(raster_mask, 0, where=valid)
+        if pool is not None:
+            pool.give(filled)
+    if pool is not None:
+        pool.give(valid)
+
+
+#############################
+def new_scene_raster(shape, band, pool=None):
+    # Destination of a warped scene, all pixels are written by warp_band
+    dtype = numpy.uint16 if band == 'quality' else numpy.int16
+    if pool is not None:
+        return pool.take(shape, dtype)
+    return numpy.zeros(shape, dtype=dtype)
+
+
+def new_merge_rasters(shape, band, nodata, pool=None):
+    # Merged image and, for quality band, the mask of pixels not filled yet
+    take = pool.take if pool is not None else numpy.empty
+    if band == 'quality':
+        raster_merge = take(shape, numpy.uint16)
+        raster_merge.fill(0)
+        raster_mask = take(shape, numpy.uint16)
+        raster_mask.fill(1)
+    else:
+        raster_merge = take(shape, numpy.int16)
+        raster_merge.fill(nodata)
+        raster_mask = None
+    return raster_merge, raster_mask
+
+
+def get_source_window(src, crs, transform, width, height):
+    # Window of the source scene over the target grid (crs, transform, width, height), not rounded
+    bounds = array_bounds(height, width, transform)
+    west, south, east, north = transform_bounds(crs, src.crs, *bounds, densify_pts=21)
+    return from_bounds(west, south, east, north, transform=src.transform)
+
+
+def get_warp_scale(src, crs, transform, width, height):
+    """
+    Target pixels per source pixel (x, y) over the whole target grid. GDAL computes it for each
+    warped chunk from its source window, so the resampling kernel changes between windows,
+    with the scale of the grid all windows are warped with the same kernel.
+    """
+    window = get_source_window(src, crs, transform, width, height)
+    return width / float(window.width), height / float(window.height)
+
+
+def get_footprint_window(src, crs, transform, width, height, margin=2):
+    """
+    Window of the source scene that covers the target grid (crs, transform, width, height).
+    A margin of source pixels is kept for the resampling kernel.
+    Returns None when the scene does not intersect the target.
+    """
+    window = get_source_window(src, crs, transform, width, height)
+
+    col_off = max(int(math.floor(window.col_off)) - margin, 0)
+    row_off = max(int(math.floor(window.row_off)) - margin, 0)
+    col_end = min(int(math.ceil(window.col_off + window.width)) + margin, src.width)
+    row_end = min(int(math.ceil(window.row_off + window.height)) + margin, src.height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def get_kernel_margin(scale):
+    # Source pixels around a footprint read that the resampling kernels (up to lanczos,
+    # radius 3) may use, wider when the source is downsampled
+    return int(math.ceil(3. / min(scale[0], scale[1], 1.))) + 1
+
+
+def fits_dtype(value, dtype):
+    dtype = numpy.dtype(dtype)
+    info = numpy.iinfo(dtype) if numpy.issubdtype(dtype, numpy.integer) else numpy.finfo(dtype)
+    return info.min <= value <= info.max
+
+
+def read_warped(src, source_nodata, raster, crs, transform, nodata, resampling, scale):
+    """
+    Warp the first band of src into raster with a WarpedVRT of the target grid.
+
+    The transformer is almost exact (GDAL approximates it by chunk otherwise) and the kernel
+    uses `scale`, so a window of the grid has the same pixels as the whole grid warped at once.
+    The VRT has the data type of src, when nodata does not fit in it the VRT uses source_nodata,
+    replaced by nodata in raster (GDAL does not write valid pixels with the nodata value).
+    """
+    vrt_nodata = nodata if fits_dtype(nodata, src.dtypes[0]) else source_nodata
+    # not verified that GDAL 2.4 (rasterio wheels of the lambda) honours XSCALE/YSCALE, if it
+    # ignores them the kernel of a window follows its own scale, see benchmarks/merge_memory.py
+    options = dict(XSCALE='{:.12f}'.format(scale[0]), YSCALE='{:.12f}'.format(scale[1]))
+    # tolerance=0 makes WarpedVRT build no transformer at all (GDALSetProjection fails),
+    # a tiny positive one keeps the approximate transformer exact to the pixel
+    with WarpedVRT(src, crs=crs, transform=transform, width=raster.shape[1], height=raster.shape[0],
+                   src_nodata=source_nodata, nodata=vrt_nodata, resampling=resampling,
+                   tolerance=1e-9, **options) as vrt:
+        if vrt.dtypes[0] == raster.dtype.name:
+            vrt.read(1, out=raster)
+        else:
+            numpy.copyto(raster, vrt.read(1), casting='unsafe')
+
+    if vrt_nodata != nodata:
+        raster[raster == vrt_nodata] = nodata
+    return raster
+
+
+def warp_band(src, source_nodata, raster, crs, transform, nodata, resampling, read='band', scale=None):
+    """
+    Reproject the first band of src into raster, see `read_warped`.
+
+    read='band' lets GDAL warper read from the dataset, read='footprint' reads only the
+    window of the scene that intersects the target grid and warps it from memory, with the
+    same pixels. `scale` is the one of the whole target grid when raster is one of its windows
+    (see `get_warp_scale`), by default the one of raster.
+    """
+    if scale is None:
+        scale = get_warp_scale(src, crs, transform, raster.shape[1], raster.shape[0])
+
+    if read == 'footprint':
+        window = get_footprint_window(src, crs, transform, raster.shape[1], raster.shape[0],
+                                      margin=get_kernel_margin(scale))
+        if window is None:
+            raster.fill(nodata)
+            return raster
+
+        # the window keeps its offset transform, so GDAL computes the same source coordinates
+        profile = dict(driver='GTiff', count=1, dtype=src.dtypes[0], crs=src.crs,
+                       transform=src.window_transform(window), width=int(window.width),
+                       height=int(window.height))
+        if fits_dtype(source_nodata, src.dtypes[0]):
+            profile['nodata'] = source_nodata
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(src.read(1, window=window), 1)
+            # warped from a read-only dataset, the writer is closed so the file is complete
+            with memfile.open() as footprint:
+                return read_warped(footprint, source_nodata, raster, crs, transform, nodata,
+                                   resampling, scale)
+
+    return read_warped(src, source_nodata, raster, crs, transform, nodata, resampling, scale)
+
+
+#############################
+def merge_full(links, dataset, band, crs, transform, numcol, numlin, nodata, resampling, workers=1,
+               read='band', pool=None):
+    """
+    Warp and merge all scenes of a date into a full tile array.
+
+    With `workers` > 1 the scenes are opened and warped concurrently in a thread pool
+    (GDAL releases the GIL), but they are still merged in the order of `links`.
+    `read` is the way scenes are read, see `warp_band`.
+    Scene and work arrays are reused from `pool` (BufferPool), so only the scenes in flight
+    are allocated.
+    Returns the merged raster and the profile to write it.
+    """
+    pool = pool if pool is not None else BufferPool()
+    shape = (numlin, numcol,)
+    raster_merge, raster_mask = new_merge_rasters(shape, band, nodata)
+
+    def warp_scene(item):
+        index, url = item
+        with rasterio.Env(CPL_CURL_VERBOSE=False):
+            with rasterio.open(url) as src:
+                source_nodata = get_source_nodata(src, dataset, band, nodata)
+                destination = new_scene_raster(shape, band, pool)
+                warp_band(src, source_nodata, destination, crs, transform, nodata, resampling, read)
+
+                scene_template = None
+                if index == 0:
+                    scene_template = get_merge_template(src, crs, transform, numcol, numlin,
+                        source_nodata, band, nodata)
+                return destination, scene_template
+
+    # For all files
+    template = None
+    for scene, scene_template in ordered_map(warp_scene, list(enumerate(links)), workers):
+        merge_scene(scene, raster_merge, raster_mask, band, nodata, pool)
+        pool.give(scene)
+
+        if template is None:
+            template = scene_template
+
+    return raster_merge, template
+
+
+#############################
+def merge_block_windows(numcol, numlin, block_size):
+    # Windows of the output grid aligned to the GeoTIFF blocks
+    for row_off in range(0, numlin, block_size):
+        for col_off in range(0, numcol, block_size):
+            yield Window(col_off, row_off,
+                min(block_size, numcol - col_off),
+                min(block_size, numlin - row_off))
+
+
+def merge_windowed(links, dataset, band, crs, transform, numcol, numlin, nodata, resampling,
+                   block_size, write, workers=1, read='band', pool=None):
+    """
+    Warp and merge all scenes of a date one output block at a time.
+
+    Each window of `block_size` is reprojected from every scene, composited with the same rules
+    of `merge_full` and handed to `write(window, raster_merge)`, so the memory used depends on
+    the block size and not on the tile size. The merged pixels are the ones of `merge_full`.
+    With `workers` > 1 the scenes of a window are warped concurrently, each dataset is used by
+    one thread at a time.
+    The arrays of a window are reused from `pool` (BufferPool) in the next windows, `write`
+    must copy the merged raster.
+    Returns the profile to write the merged image.
+    """
+    pool = pool if pool is not None else BufferPool()
+    template = None
+    with rasterio.Env(CPL_CURL_VERBOSE=False):
+        sources = []
+        try:
+            # the kernel of every window uses the scale of the whole tile, see get_warp_scale
+            for url in links:
+                src = rasterio.open(url)
+                sources.append((src, get_source_nodata(src, dataset, band, nodata),
+                                get_warp_scale(src, crs, transform, numcol, numlin)))
+
+            src, source_nodata, _ = sources[0]
+            template = get_merge_template(src, crs, transform, numcol, numlin,
+                source_nodata, band, nodata)
+
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                for window in merge_block_windows(numcol, numlin, block_size):
+                    shape = (int(window.height), int(window.width),)
+                    dst_transform = window_transform(window, transform)
+                    raster_merge, raster_mask = new_merge_rasters(shape, band, nodata, pool)
+
+                    if workers <= 1:
+                        scenes = (warp_band(src, source_nodata, new_scene_raster(shape, band, pool), crs,
+                                            dst_transform, nodata, resampling, read, scale)
+                                  for src, source_nodata, scale in sources)
+                    else:
+                        scenes = [executor.submit(warp_band, src, source_nodata,
+                                                  new_scene_raster(shape, band, pool),
+                                                  crs, dst_transform, nodata, resampling, read, scale)
+                                  for src, source_nodata, scale in sources]
+                        scenes = (future.result() for future in scenes)
+
+                    for raster in scenes:
+                        merge_scene(raster, raster_merge, raster_mask, band, nodata, pool)
+                        pool.give(raster)
+
+                    write(window, raster_merge)
+                    pool.give(raster_merge, raster_mask)
+        finally:
+            for src, _, _ in sources:
+                src.close()
+
+    return template
@@ -4,9 +4,16 @@ validation of controllers schemas
 from cerberus import Validator
 from datetime import datetime
 
+from .utils.composite import COMPOSITES, DEFAULT_FUNCTIONS
+
 def to_date(s):
     return datetime.strptime(s, '%Y-%m-%d') if s else None
 
+def to_upper_list(values):
+    if not isinstance(values, list):
+        return values
+    return [value.upper() if isinstance(value, str) else value for value in values]
+
 def to_bbox(s):
     bbox = s.split(',')
     if len(bbox) != 4:
@@ -24,7 +31,9 @@ def create():
         'license': {"type": "string", "empty": False, "required": True},
         'oauth_scope': {"type": "string", "empty": True, "required": False},
         'description': {"type": "string", "empty": False, "required": True},
-        'metadata': {'type': 'dict', 'empty': True, 'required': False, 'default': dict()}
+        'metadata': {'type': 'dict', 'empty': True, 'required': False, 'default': dict()},
+        'composite_function_list': {"type": "list", "coerce": to_upper_list, "empty": False, "required": False,
+            "allowed": ['IDENTITY'] + list(COMPOSITES), "default": DEFAULT_FUNCTIONS}
     }
     return item
 